@@ -0,0 +1,94 @@
+# coding: utf8
+"""An asyncio client for the job RPC servers of app.rpc, so the gateway
+can wait for many job calls at once without a thread per call.
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import ujson
+from app.rpc import HEADER, IDEMPOTENT_METHODS, RPCError, RPCConnectionError
+
+
+class AsyncRPCClient(object):
+    def __init__(self, timeout=60.0):
+        """Call jobs on workers, keeping the connections open between calls.
+        Each call uses its own connection.
+
+        timeout (float): Seconds to wait for a reply.
+        """
+        self.timeout = timeout
+        self.idle = {}
+
+    async def call(self, address, job_id, method, *args):
+        """
+        address (unicode): The worker's RPC address, as 'host:port'.
+        job_id (unicode): The job to call.
+        method (unicode): The job method, e.g. 'get_questions'.
+        *args: Arguments of the job method.
+        RETURNS: The result of the job method.
+        """
+        message = {'job': job_id, 'method': method, 'args': list(args)}
+        retries = 1
+        while True:
+            conn = await self.checkout(address)
+            try:
+                reply = await self.send(conn, message)
+                break
+            except RPCConnectionError as e:
+                # the request wasn't sent, so it's sent again on a new
+                # connection, like RPCClient.call
+                conn[1].close()
+                self.close(address)
+                if not retries:
+                    raise RPCConnectionError('{}: {}'.format(address, e))
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                # the worker may have run the call, so only calls without
+                # side effects are sent again
+                conn[1].close()
+                if not retries or method not in IDEMPOTENT_METHODS:
+                    raise RPCError('{}: {}'.format(address, str(e) or 'timed out'))
+            retries -= 1
+        self.idle.setdefault(address, []).append(conn)
+        if 'error' in reply:
+            raise RPCError(reply['error'])
+        return reply['result']
+
+    async def send(self, conn, message):
+        """Send a request and wait for the reply. Raises RPCConnectionError
+        if the request couldn't be sent.
+        """
+        reader, writer = conn
+        payload = ujson.dumps(message, escape_forward_slashes=False).encode('utf8')
+        try:
+            writer.write(HEADER.pack(len(payload)) + payload)
+            await writer.drain()
+        except OSError as e:
+            # the worker ignores incomplete frames
+            raise RPCConnectionError(e)
+        header = await asyncio.wait_for(reader.readexactly(HEADER.size), self.timeout)
+        payload = await asyncio.wait_for(reader.readexactly(HEADER.unpack(header)[0]), self.timeout)
+        return ujson.loads(payload)
+
+    async def checkout(self, address):
+        idle = self.idle.get(address)
+        while idle:
+            reader, writer = idle.pop()
+            # workers only send replies, so an idle connection that got an
+            # EOF or an error was closed
+            if reader.at_eof() or reader.exception() is not None or writer.transport.is_closing():
+                writer.close()
+                continue
+            return reader, writer
+        return await self.connect(address)
+
+    async def connect(self, address):
+        host, port = address.rsplit(':', 1)
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(host, int(port)), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise RPCConnectionError('{}: {}'.format(address, e))
+
+    def close(self, address):
+        """Close the idle connections to a worker, e.g. after it went away."""
+        for reader, writer in self.idle.pop(address, []):
+            writer.close()
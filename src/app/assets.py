@@ -0,0 +1,121 @@
+# coding: utf8
+"""The static files of the annotation app, indexed once at startup. Text
+files are compressed ahead of time with gzip, and brotli if it's
+installed, and every file has a hash of its contents, so URLs with the
+hash can be cached for good.
+"""
+from __future__ import unicode_literals
+
+import io
+import os
+import gzip
+import mimetypes
+from hashlib import md5
+from collections import namedtuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+Asset = namedtuple('Asset', ['path', 'mimetype', 'hash', 'variants'])
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'application/xml',
+                'image/svg+xml', 'image/x-icon', 'application/x-font-ttf', 'font/ttf')
+
+
+def compress_gzip(data):
+    f = io.BytesIO()
+    # no mtime, so the same file always compresses to the same bytes
+    with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9, mtime=0) as gz:
+        gz.write(data)
+    return f.getvalue()
+
+
+def compress_brotli(data):
+    return brotli.compress(data, quality=11)
+
+
+# preferred encodings first
+ENCODINGS = [('gzip', 'gz', compress_gzip)]
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', 'br', compress_brotli))
+
+
+class StaticAssets(object):
+    def __init__(self, root, cache_dir, min_size=1024):
+        """Index the files of a directory and build their compressed
+        variants, unless an earlier run already built them.
+
+        root (unicode): The directory of the files.
+        cache_dir (unicode): Where to keep the compressed variants.
+        min_size (int): Files smaller than this (in bytes) aren't compressed.
+        """
+        self.root = root
+        self.cache_dir = cache_dir
+        self.min_size = min_size
+        self.assets = {}
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, root).replace(os.sep, '/')
+                self.assets[name] = self.index(path)
+
+    def index(self, path):
+        """
+        path (unicode): Path of a file.
+        RETURNS (Asset): The file with its mimetype, the hash of its contents
+            and the paths of its compressed variants, keyed by encoding.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = md5(data).hexdigest()[:16]
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        variants = {}
+        if len(data) >= self.min_size and mimetype.startswith(COMPRESSIBLE):
+            for encoding, ext, compress in ENCODINGS:
+                variant = os.path.join(self.cache_dir, '{}.{}'.format(digest, ext))
+                if not os.path.exists(variant):
+                    compressed = compress(data)
+                    if len(compressed) >= len(data):
+                        continue
+                    tmp_path = '{}.{}.tmp'.format(variant, os.getpid())
+                    with open(tmp_path, 'wb') as f:
+                        f.write(compressed)
+                    os.rename(tmp_path, variant)
+                variants[encoding] = variant
+        return Asset(path, mimetype, digest, variants)
+
+    def get(self, name):
+        """
+        name (unicode): The path of a file relative to the root.
+        RETURNS (Asset): The file, or None if there's no such file.
+        """
+        return self.assets.get(name)
+
+    def url(self, name):
+        """
+        name (unicode): The path of a file relative to the root.
+        RETURNS (unicode): The relative URL of the file with the hash of its
+            contents, which changes whenever the file does.
+        """
+        asset = self.assets.get(name)
+        if asset is None:
+            return name
+        return '{}?v={}'.format(name, asset.hash)
+
+    def select(self, asset, accept_encodings):
+        """
+        asset (Asset): The file to send.
+        accept_encodings (werkzeug.datastructures.Accept): The encodings the
+            client accepts.
+        RETURNS (tuple): The encoding, or None if the file is sent as it is,
+            and the path of the file to send.
+        """
+        for encoding, _, _ in ENCODINGS:
+            if encoding in asset.variants and accept_encodings[encoding] > 0:
+                return encoding, asset.variants[encoding]
+        return None, asset.path
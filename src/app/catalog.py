@@ -0,0 +1,112 @@
+# coding: utf8
+"""The project catalog shown on the dashboard, with the instructions of the
+projects. Instruction files are read once and only read again when their
+mtime changes, and the catalog of a user is only rebuilt when one of them
+changed, so it can be validated with an ETag.
+"""
+from __future__ import unicode_literals
+
+import io
+import os
+import threading
+import ujson
+from hashlib import md5
+
+
+class FileCache(object):
+    def __init__(self):
+        """Keep the contents of small text files, validated by their mtime
+        and size.
+        """
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def read(self, path):
+        """
+        path (unicode): Path of the file.
+        RETURNS (tuple): The file's contents and its mtime, or (None, None)
+            if it's not a file.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None, None
+        key = (stat.st_mtime, stat.st_size)
+        cached = self.files.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1], stat.st_mtime
+        with io.open(path, 'r', encoding='utf8') as f:
+            text = f.read()
+        with self.lock:
+            self.files[path] = (key, text)
+        return text, stat.st_mtime
+
+
+INSTRUCTIONS = FileCache()
+
+
+def get_instructions_path(value, data_dir):
+    """
+    value (unicode): The 'instructions' of a project, e.g.
+        '{data_dir}/manual_all/instructions.html'.
+    data_dir (unicode): The data directory.
+    RETURNS (unicode): The path of the instructions file.
+    """
+    if '{data_dir}' in value:
+        return value.replace('{data_dir}', data_dir)
+    return '{}/{}'.format(data_dir, value)
+
+
+def get_instructions(value, data_dir):
+    """
+    value (unicode): The 'instructions' of a project.
+    data_dir (unicode): The data directory.
+    RETURNS (tuple): The instructions and the mtime of their file. If there's
+        no such file, the value itself is the instructions and the mtime is 0.
+    """
+    text, mtime = INSTRUCTIONS.read(get_instructions_path(value, data_dir))
+    if text is None:
+        return value, 0
+    return text, mtime
+
+
+class ProjectCatalog(object):
+    def __init__(self, projects, data_dir):
+        """The visible projects, with their instructions, as seen by a user.
+
+        projects (dict): The project settings, keyed by project id.
+        data_dir (unicode): The data directory.
+        """
+        self.projects = projects
+        self.data_dir = data_dir
+        self.catalogs = {}
+        self.lock = threading.Lock()
+
+    def get(self, username=None):
+        """
+        username (unicode): The user, or None to only get the projects that
+            aren't limited to some users.
+        RETURNS (tuple): The projects as a list of dicts with 'name', 'desc'
+            and 'instructions', an ETag of the list and the mtime of its
+            newest instructions file.
+        """
+        items = []
+        mtimes = []
+        for key, value in self.projects.items():
+            # skip if not visible, or if user is not in only_user list (if not defined all users are allowed)
+            if value['visible'] != True or ('only_user' in value and username not in value['only_user']):
+                continue
+            item = {'name': key, 'desc': value['desc']}
+            if 'instructions' in value:
+                item['instructions'], mtime = get_instructions(value['instructions'], self.data_dir)
+                mtimes.append(mtime)
+            items.append(item)
+        key = tuple(mtimes)
+        cached = self.catalogs.get(username)
+        if cached is not None and cached[0] == key:
+            return cached[1:]
+        etag = md5(ujson.dumps(items, sort_keys=True).encode('utf8')).hexdigest()
+        catalog = (key, items, etag, max(mtimes) if mtimes else 0)
+        with self.lock:
+            self.catalogs[username] = catalog
+        return catalog[1:]
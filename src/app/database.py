@@ -2,7 +2,15 @@
 from __future__ import unicode_literals
 
 import peewee as orm
+from playhouse.pool import PooledDatabase
+from playhouse.migrate import SchemaMigrator, migrate
+import time
+import datetime
+import zlib
+import sqlite3
+from hashlib import md5
 from pathlib import Path
+from collections import OrderedDict, Counter
 import ujson
 
 from prodigy.util import PRODIGY_HOME, TASK_HASH_ATTR, INPUT_HASH_ATTR, log
@@ -11,6 +19,30 @@ from prodigy.util import get_config, get_entry_points, convert_blob, get_display
 
 DB_PROXY = orm.Proxy()
 _DB = None
+BULK_INSERT_SIZE = 500
+# Seconds a process trusts its cached dataset rows, to pick up datasets
+# dropped or changed by other processes
+DATASET_CACHE_TTL = 60
+# Seconds a process trusts its cached users, to pick up users changed or
+# deleted by other processes
+USER_CACHE_TTL = 60
+# Seconds a pooled connection can sit idle before it's pinged on checkout
+POOL_HEALTH_CHECK_INTERVAL = 30
+
+# Compressed example blobs start with a header that can't begin a JSON
+# document, followed by a format flag, so uncompressed rows still load.
+BLOB_HEADER = b'\x00PZ'
+BLOB_ZLIB = b'\x00'
+BLOB_ZLIB_DICT = b'\x01'
+BLOB_COMPRESS_LEVEL = 6
+# Preset zlib dictionary with the strings most annotated tasks repeat. The
+# most frequent ones go last, because they're the cheapest to reference.
+BLOB_DICT = (b'"image":"data:image/"options":[{"id":"accept":["meta":{"score":'
+             b'"source":"html":"label":"ignore""reject"'
+             b'"token_start":"token_end":"_session_id":"_view_id":"ner_manual"'
+             b'"_input_hash":"_task_hash":"answer":"accept"'
+             b'"spans":[{"start":"end":"label":"text":"'
+             b'"tokens":[{"text":"start":"end":"id":"ws":true},{"text":"')
 
 
 def get_db():
@@ -19,6 +51,29 @@ def get_db():
     return _DB
 
 
+def use_for_prodigy(db):
+    """Make prodigy.components.db.connect return the app's database, also
+    in the recipe modules that already imported it, so prodigy's built-in
+    recipes read datasets through it, e.g. ner.batch-train. Only the app's
+    database can decode compressed example blobs.
+
+    db (Database): The database.
+    """
+    import sys
+    import prodigy.components.db as prodigy_db
+
+    def connect_app_db(*args, **kwargs):
+        return db
+
+    connect_app_db.app_db = True
+    original = getattr(prodigy_db, 'prodigy_connect', prodigy_db.connect)
+    prodigy_db.prodigy_connect = original
+    for module in list(sys.modules.values()):
+        value = getattr(module, 'connect', None)
+        if value is original or getattr(value, 'app_db', False):
+            module.connect = connect_app_db
+
+
 def disconnect():
     """Disconnect the shared database instance and revert it back to None type"""
     global _DB
@@ -54,8 +109,11 @@ def connect(db_id=None, db_settings=None):
         db_settings = config_db_settings.get(db_id, {})
     if db_id not in connectors:
         raise ValueError("Invalid database id: {}".format(db_id))
+    db_settings = dict(db_settings)
+    dedupe = db_settings.pop('dedupe', False)
+    compress = db_settings.pop('compress', False)
     db_name, db = connectors[db_id](**db_settings)
-    _DB = Database(db, db_id, db_name)
+    _DB = Database(db, db_id, db_name, dedupe=dedupe, compress=compress)
     log("DB: Connecting to database {}".format(db_name), db_settings)
     return _DB
 
@@ -73,18 +131,47 @@ class Dataset(BaseModel):
 
 
 class Example(BaseModel):
-    input_hash = orm.BigIntegerField()
-    task_hash = orm.BigIntegerField()
+    input_hash = orm.BigIntegerField(index=True)
+    task_hash = orm.BigIntegerField(index=True)
     content = orm.BlobField()
+    created = orm.TimestampField(null=True)
+    # only set on rows stored with dedupe, which are unique by content
+    content_hash = orm.CharField(max_length=32, null=True)
 
-    def load(self):
-        content = convert_blob(self.content)
-        return ujson.loads(content)
+    class Meta:
+        indexes = ((('task_hash', 'content_hash'), True),)
+
+    def load(self, keys=None):
+        """
+        keys (list): Optional top-level keys to decode. Defaults to all keys.
+        RETURNS (dict): The decoded example.
+        """
+        return load_content(self.content, keys)
 
 
 class Link(BaseModel):
     example = orm.ForeignKeyField(Example)
     dataset = orm.ForeignKeyField(Dataset)
+    created = orm.TimestampField(null=True)
+    # the example's answer, so answers can be counted in the database
+    answer = orm.CharField(null=True)
+
+    class Meta:
+        indexes = ((('dataset', 'example'), False),)
+
+
+class AnswerCount(BaseModel):
+    dataset = orm.ForeignKeyField(Dataset)
+    answer = orm.CharField()
+    count = orm.IntegerField(default=0)
+
+    class Meta:
+        indexes = ((('dataset', 'answer'), True),)
+
+
+class Migration(BaseModel):
+    name = orm.CharField(unique=True)
+    created = orm.TimestampField()
 
 
 class User(BaseModel):
@@ -92,20 +179,192 @@ class User(BaseModel):
     password = orm.CharField()
     email = orm.CharField()
 
+    def save(self, *args, **kwargs):
+        result = super(User, self).save(*args, **kwargs)
+        USER_CACHE.invalidate(self.id)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        result = super(User, self).delete_instance(*args, **kwargs)
+        USER_CACHE.invalidate(self.id)
+        return result
+
+
+class UserCache(object):
+    def __init__(self, ttl=USER_CACHE_TTL):
+        """Users of this process, by id, so pages don't look up the
+        logged in user on every request. Users saved or deleted in this
+        process are invalidated right away, and others after the ttl.
+
+        ttl (int): Seconds a user is trusted after it was looked up.
+        """
+        self.ttl = ttl
+        self.users = {}
+
+    def get(self, user_id):
+        """
+        user_id (int): The user's id.
+        RETURNS (User): The user, or None if it doesn't exist.
+        """
+        cached = self.users.get(user_id)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+        try:
+            user = User.get(User.id == user_id)
+        except User.DoesNotExist:
+            self.users.pop(user_id, None)
+            return None
+        self.users[user_id] = (time.time() + self.ttl, user)
+        return user
+
+    def invalidate(self, user_id):
+        """
+        user_id (int): The id of a user that changed.
+        """
+        self.users.pop(user_id, None)
+
+
+USER_CACHE = UserCache()
+
+
+def dump_content(eg, compress=False):
+    """Encode an example for storage. Compressed blobs keep the JSON of each
+    top-level value separately, behind an index of byte offsets, so single
+    keys can be decoded without parsing the whole example.
+
+    eg (dict): The example.
+    compress (bool): Whether to write a compressed blob.
+    RETURNS: The JSON string, or the compressed blob as bytes.
+    """
+    if not compress:
+        return ujson.dumps(eg, escape_forward_slashes=False)
+    index = []
+    values = []
+    offset = 0
+    for key, value in eg.items():
+        data = ujson.dumps(value, escape_forward_slashes=False).encode('utf8')
+        index.append((key, offset, offset + len(data)))
+        values.append(data)
+        offset += len(data)
+    payload = ujson.dumps(index).encode('utf8') + b'\n' + b''.join(values)
+    compressor = zlib.compressobj(BLOB_COMPRESS_LEVEL, zdict=BLOB_DICT)
+    return BLOB_HEADER + BLOB_ZLIB_DICT + compressor.compress(payload) + compressor.flush()
+
+
+def load_content(content, keys=None):
+    """Decode a stored example blob, compressed or not.
+
+    content: The blob, as returned by the database driver.
+    keys (list): Optional top-level keys to decode. Defaults to all keys.
+    RETURNS (dict): The decoded example.
+    """
+    data = blob_bytes(content)
+    if not data.startswith(BLOB_HEADER):
+        eg = ujson.loads(convert_blob(content))
+        if keys is None:
+            return eg
+        return dict((key, value) for key, value in eg.items() if key in keys)
+    flag = data[len(BLOB_HEADER):len(BLOB_HEADER) + 1]
+    if flag == BLOB_ZLIB_DICT:
+        decompressor = zlib.decompressobj(zdict=BLOB_DICT)
+    elif flag == BLOB_ZLIB:
+        decompressor = zlib.decompressobj()
+    else:
+        raise ValueError("Unknown example blob format: {!r}".format(flag))
+    payload = decompressor.decompress(data[len(BLOB_HEADER) + 1:]) + decompressor.flush()
+    index, values = payload.split(b'\n', 1)
+    eg = {}
+    for key, start, end in ujson.loads(index):
+        if keys is None or key in keys:
+            eg[key] = ujson.loads(values[start:end])
+    return eg
+
+
+def blob_bytes(content):
+    """Get the raw bytes of an encoded or stored example blob."""
+    if isinstance(content, (memoryview, bytearray)):
+        return bytes(content)
+    if isinstance(content, bytes):
+        return content
+    return content.encode('utf8')
+
+
+def get_content_hash(content):
+    """
+    content: An encoded example, see dump_content.
+    RETURNS (unicode): The MD5 hex digest of the blob.
+    """
+    return md5(blob_bytes(content)).hexdigest()
+
+
+def chunked(rows, size):
+    """Split a list of rows into lists of at most `size` rows."""
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def get_pool_settings(settings):
+    """Pop the connection pool settings. Pooling is enabled by setting
+    max_connections, stale_timeout sets the maximum age in seconds of a
+    pooled connection before it's closed and replaced, and pool_timeout the
+    seconds to wait for a connection while all are in use, before
+    MaxConnectionsExceeded is raised.
+
+    settings (dict): The database settings.
+    RETURNS (dict): The pool settings, or None if pooling is disabled.
+    """
+    pool = {}
+    for setting in ('max_connections', 'stale_timeout'):
+        if setting in settings:
+            pool[setting] = settings.pop(setting)
+    if 'pool_timeout' in settings:
+        pool['timeout'] = settings.pop('pool_timeout')
+    return pool if pool.get('max_connections') else None
+
 
 def connect_sqlite(**settings):
     database = settings.pop('name', 'prodigy.db')
     path = settings.pop('path', PRODIGY_HOME)
+    get_pool_settings(settings)  # connecting to a file is cheap
     if database != ':memory:':
         database = str(Path(path) / database)
     return 'SQLite', orm.SqliteDatabase(database, **settings)
 
 
+def patch_psycopg():
+    """Make psycopg2 wait for the database without blocking the other
+    greenlets, if the process runs a gevent pool, e.g. a worker started with
+    -P gevent. psycopg2 is a C extension, so gevent's monkey patching doesn't
+    reach it, and every query would block all jobs of the worker.
+
+    RETURNS (bool): Whether psycopg2 yields to other greenlets.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    if not monkey.is_module_patched('socket'):
+        return False
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        log("DB: psycogreen isn't installed, queries block the gevent pool")
+        return False
+    patch_psycopg()
+    return True
+
+
 def connect_postgresql(**settings):
+    patch_psycopg()
     database = 'prodigy'
     for setting in ('db', 'name', 'dbname', 'database'):
         if setting in settings:
             database = settings.pop(setting)
+    pool = get_pool_settings(settings)
+    if pool:
+        from playhouse.pool import PooledPostgresqlDatabase
+        settings.update(pool)
+        return 'PostgreSQL', PooledPostgresqlDatabase(database, **settings)
     return 'PostgreSQL', orm.PostgresqlDatabase(database, **settings)
 
 
@@ -114,27 +373,137 @@ def connect_mysql(**settings):
     for setting in ('db', 'name', 'dbname', 'database'):
         if setting in settings:
             database = settings.pop(setting)
+    pool = get_pool_settings(settings)
+    if pool:
+        from playhouse.pool import PooledMySQLDatabase
+        settings.update(pool)
+        return 'MySQL', PooledMySQLDatabase(database, **settings)
     return 'MySQL', orm.MySQLDatabase(database, **settings)
 
 
 class Database(object):
-    def __init__(self, db, display_id='custom', display_name=None):
+    def __init__(self, db, display_id='custom', display_name=None, dedupe=False,
+                 compress=False):
         """Initialize a database.
 
         db: A database object that can be initialized by peewee.
         display_id (unicode): Database ID used for logging, e.g. 'sqlite'.
         display_name (unicode): Database name used for logging, e.g. 'SQLite'.
+        dedupe (bool): Store identical examples only once and link the
+            existing rows, instead of adding a new row on every save.
+        compress (bool): Write new examples as compressed blobs. Rows that
+            were stored uncompressed can still be read.
         RETURNS (Database): The initialized database.
         """
         DB_PROXY.initialize(db)
         self.db_id = display_id
         self.db_name = display_name or get_display_name(db)
+        self.pooled = isinstance(db, PooledDatabase)
+        self.dedupe = dedupe
+        self.compress = compress
+        self._datasets = {}
+        # when each pooled connection last passed a health check, by id
+        self._checked = {}
+        self.db = DB_PROXY
         log("DB: Initialising database {}".format(self.db_name))
         try:
-            DB_PROXY.create_tables([User, Dataset, Example, Link], safe=True)
+            DB_PROXY.create_tables([User, Dataset, Example, Link, AnswerCount, Migration],
+                                  safe=True)
         except orm.OperationalError:
-            pass
-        self.db = DB_PROXY
+            # another process created the tables at the same time
+            self.db.rollback()
+        self.migrate()
+
+    def migrate(self):
+        """Add the columns and indexes used by the lookups to tables created
+        before they were declared on the models, and run the data migrations
+        that haven't run on the database yet. Columns and indexes that
+        already exist are left alone, including ones that another process
+        adds at the same time. Other errors are raised.
+        """
+        for model, field in [(Example, Example.created), (Example, Example.content_hash),
+                             (Link, Link.created), (Link, Link.answer)]:
+            if self.has_column(model, field):
+                continue
+            log("DB: Adding column {}.{}".format(model._meta.db_table, field.db_column))
+            migrator = SchemaMigrator.from_database(self.db.obj)
+            try:
+                migrate(migrator.add_column(model._meta.db_table, field.db_column, field))
+            except orm.DatabaseError:
+                self.db.rollback()
+                if not self.has_column(model, field):
+                    raise
+        indexes = [(Example, [Example.task_hash], False),
+                   (Example, [Example.input_hash], False),
+                   (Example, [Example.task_hash, Example.content_hash], True),
+                   (Link, [Link.dataset, Link.example], False)]
+        for model, fields, unique in indexes:
+            if self.has_index(model, fields):
+                continue
+            log("DB: Creating index on {} ({})"
+                .format(model._meta.db_table, ', '.join(f.db_column for f in fields)))
+            try:
+                self.db.create_index(model, fields, unique=unique)
+            except orm.DatabaseError:
+                self.db.rollback()
+                if not self.has_index(model, fields):
+                    raise
+        self.run_migration('link_answers', self.add_link_answers)
+
+    def run_migration(self, name, func):
+        """Run a data migration once per database. Its marker row is
+        inserted in the same transaction, so a process starting at the same
+        time waits for it on the unique name and then leaves it alone.
+
+        name (unicode): The name of the migration.
+        func (callable): The function that migrates the data.
+        """
+        if Migration.select().where(Migration.name == name).exists():
+            return
+        log("DB: Running migration '{}'".format(name))
+        try:
+            with self.db.atomic():
+                Migration.create(name=name, created=datetime.datetime.now())
+                func()
+        except orm.DatabaseError:
+            self.db.rollback()
+            if not Migration.select().where(Migration.name == name).exists():
+                raise
+
+    def add_link_answers(self):
+        """Store the answers of links made before Link.answer was kept, and
+        count the answers of every dataset from them. Requests only ever add
+        to the counts after this.
+        """
+        last_id = 0
+        while True:
+            rows = list(Link
+                        .select(Link.id, Example.content)
+                        .join(Example)
+                        .where(Link.answer.is_null() & (Link.id > last_id))
+                        .order_by(Link.id)
+                        .limit(BULK_INSERT_SIZE)
+                        .tuples())
+            links = {}
+            for last_id, content in rows:
+                answer = load_content(content, ['answer']).get('answer')
+                if answer is not None:
+                    links.setdefault(answer, []).append(last_id)
+            for answer, link_ids in links.items():
+                Link.update(answer=answer).where(Link.id << link_ids).execute()
+            if len(rows) < BULK_INSERT_SIZE:
+                break
+        for dataset in Dataset.select():
+            self.recount_answers(dataset)
+
+    def has_column(self, model, field):
+        columns = self.db.get_columns(model._meta.db_table)
+        return any(column.name == field.db_column for column in columns)
+
+    def has_index(self, model, fields):
+        columns = [f.db_column for f in fields]
+        indexes = self.db.get_indexes(model._meta.db_table)
+        return any(list(index.columns) == columns for index in indexes)
 
     def __bool__(self):
         return True
@@ -150,11 +519,26 @@ class Database(object):
         name (unicode): Name of the dataset.
         RETURNS (bool): Whether the dataset exists in the database.
         """
+        return self.get_cached_dataset(name) is not None
+
+    def get_cached_dataset(self, name):
+        """Get a dataset row, from the per-process cache if it was looked up
+        in the last DATASET_CACHE_TTL seconds. Missing datasets aren't cached,
+        so datasets created by other processes are found right away.
+
+        name (unicode): The dataset name.
+        RETURNS (Dataset): The dataset, or None if it doesn't exist.
+        """
+        cached = self._datasets.get(name)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
         try:
-            has_ds = bool(Dataset.get(Dataset.name == name))
+            dataset = Dataset.get(Dataset.name == name)
         except Dataset.DoesNotExist:
-            has_ds = False
-        return has_ds
+            self._datasets.pop(name, None)
+            return None
+        self._datasets[name] = (time.time() + DATASET_CACHE_TTL, dataset)
+        return dataset
 
     @property
     def datasets(self):
@@ -179,7 +563,8 @@ class Database(object):
     def close(self):
         """
         Close the database connection (if not already closed). Called after
-        API requests to avoid timeout issues, especially with MySQL.
+        API requests to avoid timeout issues, especially with MySQL. Pooled
+        connections are returned to the pool instead.
         """
         if not self.db.is_closed():
             self.db.close()
@@ -188,16 +573,49 @@ class Database(object):
         """
         Reconnect to the database. Called on API requests to avoid timeout
         issues, especiallly with MySQL. If the database connection is still
-        open, it will be closed before reconnecting.
+        open, it will be closed before reconnecting. Pooled connections are
+        checked out from the pool and kept open, and replaced if they fail
+        a health check.
         """
+        if self.pooled:
+            if self.db.is_closed():
+                self.db.connect()
+            if not self.is_healthy():
+                log("DB: Replacing broken pooled connection")
+                self._checked.pop(id(self.db.get_conn()), None)
+                self.db.manual_close()
+                self.db.connect()
+            return
         if not self.db.is_closed():
             self.db.close()
         self.db.connect()
 
-    def get_examples(self, ids, by='task_hash'):
+    def is_healthy(self):
+        """Ping the connection of the current thread or greenlet, at most
+        once every POOL_HEALTH_CHECK_INTERVAL seconds per connection.
+
+        RETURNS (bool): Whether the connection is usable.
+        """
+        key = id(self.db.get_conn())
+        now = time.time()
+        if now - self._checked.get(key, 0) < POOL_HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            self.db.execute_sql('SELECT 1', require_commit=False)
+        except orm.DatabaseError:
+            return False
+        # only keep the connections that are still trusted, so closed ones
+        # don't pile up
+        self._checked = dict((conn, checked) for conn, checked in self._checked.items()
+                             if now - checked < POOL_HEALTH_CHECK_INTERVAL)
+        self._checked[key] = now
+        return True
+
+    def get_examples(self, ids, by='task_hash', keys=None):
         """
         ids (list): List of example hashes.
         by (unicode): ID to get examples by. Defaults to 'task_hash'.
+        keys (list): Optional top-level keys to decode. Defaults to all keys.
         RETURNS (list): The examples.
         """
         try:
@@ -206,38 +624,81 @@ class Database(object):
             ids = [ids]
         field = getattr(Example, by)
         ids = list(ids)
-        return [eg.load() for eg in Example.select().where(field << ids)]
+        return [eg.load(keys) for eg in Example.select().where(field << ids)]
 
     def get_meta(self, name):
         """
         name (unicode): The dataset name.
         RETURNS (dict): The dataset meta.
         """
-        if name not in self:
+        dataset = self.get_cached_dataset(name)
+        if dataset is None:
             return None
-        dataset = Dataset.get(Dataset.name == name)
         meta = convert_blob(dataset.meta)
         meta = ujson.loads(meta)
         meta['created'] = dataset.created
         return meta
 
-    def get_dataset(self, name, default=None):
+    def get_dataset(self, name, default=None, keys=None):
         """
         name (unicode): The dataset name.
         default: Return value if dataset not in database.
+        keys (list): Optional top-level keys to decode. Defaults to all keys.
         RETURNS (list): The examples in the dataset or default value.
         """
-        if name not in self:
+        if self.get_cached_dataset(name) is None:
             return default
-        dataset = Dataset.get(Dataset.name == name)
-        examples = (Example
-                    .select()
-                    .join(Link)
-                    .join(Dataset)
-                    .where(Dataset.id == dataset.id)).execute()
+        # decoded chunk by chunk, so the stored rows of the whole dataset are
+        # never in memory next to the examples, e.g. when a recipe loads its
+        # dataset as the job starts
+        examples = list(self.iter_dataset(name, keys=keys))
         log("DB: Loading dataset '{}' ({} examples)"
             .format(name, len(examples)))
-        return [eg.load() for eg in examples]
+        return examples
+
+    def iter_dataset(self, name, chunk_size=BULK_INSERT_SIZE, keys=None, since=None,
+                     answers=None):
+        """Iterate over the examples in a dataset without loading them all
+        into memory, by paging through the links in chunks. Each chunk is
+        read by its own query, so no cursor or transaction stays open while
+        the caller consumes the examples, e.g. across requests. A named
+        server-side cursor would keep memory as flat, but needs its
+        transaction, and so a pooled connection, for as long as the caller
+        takes.
+
+        name (unicode): The dataset name.
+        chunk_size (int): Number of rows fetched from the database at once.
+        keys (list): Optional top-level keys to decode. Defaults to all keys.
+        since (datetime): Only yield examples added to the dataset at or after
+            this time. Links made before their time was stored use the time
+            the example was saved, and are skipped if that's unknown too.
+        answers (list): Only yield examples with these answers, e.g.
+            ['accept']. Filtered in the query, by the answers on the links.
+        YIELDS (dict): The examples in the dataset.
+        """
+        dataset = self.get_cached_dataset(name)
+        if dataset is None:
+            return
+        log("DB: Streaming dataset '{}'".format(name))
+        where = (Link.dataset == dataset.id)
+        if since is not None:
+            where &= ((Link.created >= since) |
+                      (Link.created.is_null() & (Example.created >= since)))
+        if answers:
+            where &= (Link.answer << list(answers))
+        last_id = 0
+        while True:
+            rows = list(Example
+                        .select(Link.id, Example.content)
+                        .join(Link)
+                        .where(where & (Link.id > last_id))
+                        .order_by(Link.id)
+                        .limit(chunk_size)
+                        .tuples())
+            for last_id, content in rows:
+                yield load_content(content, keys)
+            if len(rows) < chunk_size:
+                break
 
     def get_input_hashes(self, *names):
         """
@@ -245,12 +706,14 @@ class Database(object):
         RETURNS (set): The input hashes.
         """
         datasets = Dataset.select(Dataset.id).where(Dataset.name << names)
-        examples = (Example
-                    .select(Example.input_hash)
-                    .join(Link)
-                    .join(Dataset)
-                    .where(Dataset.id << datasets)).execute()
-        return set([eg.input_hash for eg in examples])
+        query = (Example
+                 .select(Example.input_hash)
+                 .join(Link)
+                 .join(Dataset)
+                 .where(Dataset.id << datasets))
+        # read off the cursor, without caching the rows or making model
+        # instances, so only the set of hashes is kept
+        return set(input_hash for input_hash, in self.db.execute_sql(*query.sql()))
 
     def get_task_hashes(self, *names):
         """
@@ -258,12 +721,33 @@ class Database(object):
         RETURNS (set): The task hashes.
         """
         datasets = Dataset.select(Dataset.id).where(Dataset.name << names)
-        examples = (Example
-                    .select(Example.task_hash)
-                    .join(Link)
-                    .join(Dataset)
-                    .where(Dataset.id << datasets)).execute()
-        return set([eg.task_hash for eg in examples])
+        query = (Example
+                 .select(Example.task_hash)
+                 .join(Link)
+                 .join(Dataset)
+                 .where(Dataset.id << datasets))
+        # read off the cursor, without caching the rows or making model
+        # instances, so only the set of hashes is kept
+        return set(task_hash for task_hash, in self.db.execute_sql(*query.sql()))
+
+    def get_linked_task_hashes(self, name, task_hashes):
+        """
+        name (unicode): The dataset name.
+        task_hashes (list): The task hashes to look for.
+        RETURNS (set): The task hashes of the examples already in the dataset.
+        """
+        dataset = self.get_cached_dataset(name)
+        if dataset is None:
+            return set()
+        linked = set()
+        for chunk in chunked(list(set(task_hashes)), BULK_INSERT_SIZE):
+            query = (Example.select(Example.task_hash)
+                            .join(Link)
+                            .where((Link.dataset == dataset.id) &
+                                   (Example.task_hash << chunk))
+                            .tuples())
+            linked.update(task_hash for task_hash, in query)
+        return linked
 
     def add_dataset(self, name, meta={}, session=False):
         """
@@ -274,13 +758,14 @@ class Database(object):
         """
         if any([char in name for char in (',', ' ')]):
             raise ValueError("Dataset name can't include commas or whitespace")
-        try:
-            dataset = Dataset.get(Dataset.name == name)
-            log("DB: Getting dataset '{}'".format(name))
-        except Dataset.DoesNotExist:
+        dataset = self.get_cached_dataset(name)
+        if dataset is None:
             log("DB: Creating dataset '{}'".format(name), meta)
             meta = ujson.dumps(meta, escape_forward_slashes=False)
             dataset = Dataset.create(name=name, meta=meta, session=session)
+            self._datasets[name] = (time.time() + DATASET_CACHE_TTL, dataset)
+        else:
+            log("DB: Getting dataset '{}'".format(name))
         return dataset
 
     def add_examples(self, examples, datasets=tuple()):
@@ -288,38 +773,294 @@ class Database(object):
         examples (list): The examples to add.
         datasets (list): The names of the dataset(s) to add the examples to.
         """
-        with self.db.atomic():
-            ids = []
-            for eg in examples:
-                content = ujson.dumps(eg, escape_forward_slashes=False)
-                eg = Example.create(input_hash=eg[INPUT_HASH_ATTR],
-                                    task_hash=eg[TASK_HASH_ATTR],
-                                    content=content)
-                ids.append(eg.id)
         if type(datasets) is not tuple and type(datasets) is not list:
             raise ValueError('datasets must be a tuple or list type, not: {}'.format(type(datasets)))
+        examples = list(examples)
+        created = datetime.datetime.now()
+        rows = [(eg[INPUT_HASH_ATTR], eg[TASK_HASH_ATTR],
+                 dump_content(eg, self.compress), created)
+                for eg in examples]
+        with self.db.atomic():
+            if self.dedupe:
+                ids = self.upsert_examples(rows)
+            else:
+                ids = self.bulk_insert(Example, [Example.input_hash, Example.task_hash,
+                                                 Example.content, Example.created],
+                                       rows, returning=True)
+        answers = [eg.get('answer') for eg in examples]
         for dataset in datasets:
-            self.link(dataset, ids)
+            self.link(dataset, ids, answers)
         log("DB: Added {} examples to {} datasets"
             .format(len(examples), len(datasets)))
 
-    def link(self, dataset_name, example_ids):
+    def link(self, dataset_name, example_ids, answers=None):
         """
         dataset_name (unicode): The name of the dataset.
         example_ids (list): The IDs of the examples to link to the dataset.
+        answers (list): Optional answers of the examples, in the same order,
+            to update the answer counts without reading the examples back.
         """
+        example_ids = list(example_ids)
+        if answers is None:
+            answers = self.get_answers(example_ids)
+        try:
+            with self.db.atomic():
+                dataset = self.add_dataset(dataset_name)
+                self.lock_dataset(dataset, shared=True)
+                if self.dedupe:
+                    pairs = list(OrderedDict(zip(example_ids, answers)).items())
+                    linked = set()
+                    for chunk in chunked([eg for eg, _ in pairs], BULK_INSERT_SIZE):
+                        query = (Link.select(Link.example)
+                                     .where((Link.dataset == dataset.id) &
+                                            (Link.example << chunk))
+                                     .tuples())
+                        linked.update(eg for eg, in query)
+                    pairs = [(eg, answer) for eg, answer in pairs if eg not in linked]
+                    example_ids = [eg for eg, _ in pairs]
+                    answers = [answer for _, answer in pairs]
+                created = datetime.datetime.now()
+                rows = [(eg, dataset.id, created, answer)
+                        for eg, answer in zip(example_ids, answers)]
+                self.bulk_insert(Link, [Link.example, Link.dataset, Link.created,
+                                        Link.answer], rows)
+                self.count_answers(dataset, answers)
+        except Exception:
+            # don't keep a cached dataset that was created in the failed
+            # transaction and rolled back
+            self._datasets.pop(dataset_name, None)
+            raise
+
+    def get_answers(self, example_ids):
+        """
+        example_ids (list): The example IDs.
+        RETURNS (list): The answers of the examples, in the same order.
+        """
+        answers = {}
+        for chunk in chunked(list(set(example_ids)), BULK_INSERT_SIZE):
+            query = (Example.select(Example.id, Example.content)
+                            .where(Example.id << chunk)
+                            .tuples())
+            for eg_id, content in query:
+                answers[eg_id] = load_content(content, ['answer']).get('answer')
+        return [answers.get(eg_id) for eg_id in example_ids]
+
+    def count_answers(self, dataset, answers):
+        """Add newly linked answers to a dataset's answer counts. Should be
+        called in the same transaction that links the examples. The counts
+        are upserted in one statement, so processes linking the first
+        example with an answer at the same time don't conflict on the
+        unique index. Datasets created before the counts were kept are
+        counted once by migrate().
+
+        dataset (Dataset): The dataset.
+        answers (list): The answers of the newly linked examples.
+        """
+        counts = Counter(answer for answer in answers if answer is not None)
+        if not counts:
+            return
+        # always in the same order, so concurrent upserts don't deadlock
+        rows = [(dataset.id, answer, n) for answer, n in sorted(counts.items())]
+        q = self.db.quote_char
+        table = '{0}{1}{0}'.format(q, AnswerCount._meta.db_table)
+        fields = [AnswerCount.dataset, AnswerCount.answer, AnswerCount.count]
+        columns = ', '.join('{0}{1}{0}'.format(q, f.db_column) for f in fields)
+        count = '{0}{1}{0}'.format(q, AnswerCount.count.db_column)
+        values = ', '.join(['({})'.format(', '.join([self.db.interpolation] * len(fields)))] * len(rows))
+        sql = 'INSERT INTO {} ({}) VALUES {}'.format(table, columns, values)
+        params = [value for row in rows for value in row]
+        if self.db_id == 'postgresql' or (self.db_id == 'sqlite' and sqlite3.sqlite_version_info >= (3, 24)):
+            conflict = ', '.join('{0}{1}{0}'.format(q, f.db_column) for f in fields[:2])
+            sql += ' ON CONFLICT ({}) DO UPDATE SET {} = {}.{} + excluded.{}'.format(
+                conflict, count, table, count, count)
+        elif self.db_id == 'mysql':
+            sql += ' ON DUPLICATE KEY UPDATE {} = {} + VALUES({})'.format(count, count, count)
+        else:
+            for dataset_id, answer, n in rows:
+                self.add_answer_count(dataset_id, answer, n)
+            return
+        self.db.execute_sql(sql, params, require_commit=False)
+
+    def add_answer_count(self, dataset_id, answer, n):
+        """Add to an answer count without an upsert statement. If another
+        process creates the count first, the insert is rolled back to a
+        savepoint and the update is tried again.
+
+        dataset_id (int): The dataset ID.
+        answer (unicode): The answer, e.g. 'accept'.
+        n (int): The number of new examples with the answer.
+        """
+        query = (AnswerCount
+                 .update(count=AnswerCount.count + n)
+                 .where((AnswerCount.dataset == dataset_id) &
+                        (AnswerCount.answer == answer)))
+        if query.execute():
+            return
+        try:
+            with self.db.atomic():
+                AnswerCount.create(dataset=dataset_id, answer=answer, count=n)
+        except orm.IntegrityError:
+            query.execute()
+
+    def recount_answers(self, dataset):
+        """Count the answers of all examples in a dataset again, from the
+        answers on its links in one statement. The dataset is locked, so
+        processes linking examples to it wait, and their counts aren't lost.
+
+        dataset (Dataset): The dataset.
+        """
+        fields = [AnswerCount.dataset, AnswerCount.answer, AnswerCount.count]
+        query = (Link.select(Link.dataset, Link.answer, orm.fn.COUNT(Link.id))
+                     .join(Example)
+                     .where((Link.dataset == dataset.id) & Link.answer.is_null(False))
+                     .group_by(Link.dataset, Link.answer))
         with self.db.atomic():
-            dataset = self.add_dataset(dataset_name)
-            for eg in example_ids:
-                link = Link.create(dataset=dataset.id, example=eg)  # noqa F841
+            self.lock_dataset(dataset)
+            AnswerCount.delete().where(AnswerCount.dataset == dataset.id).execute()
+            AnswerCount.insert_from(fields, query).execute()
+        log("DB: Counted answers in dataset '{}'".format(dataset.name))
+
+    def lock_dataset(self, dataset, shared=False):
+        """Lock a dataset's row until the end of the transaction. Processes
+        linking examples share the lock, so they only wait for a recount of
+        the answers, and it waits for them. SQLite locks the whole database
+        on writes anyway.
+
+        dataset (Dataset): The dataset.
+        shared (bool): Whether to take a shared lock.
+        """
+        if self.db_id not in ('postgresql', 'mysql'):
+            return
+        query = Dataset.select(Dataset.id).where(Dataset.id == dataset.id)
+        query = query.with_lock('SHARE') if shared else query.for_update()
+        list(query.tuples())
+
+    def get_answer_counts(self, name):
+        """
+        name (unicode): The dataset name.
+        RETURNS (dict): The number of examples per answer, e.g. 'accept'.
+        """
+        dataset = self.get_cached_dataset(name)
+        if dataset is None:
+            return {}
+        query = (AnswerCount.select(AnswerCount.answer, AnswerCount.count)
+                            .where(AnswerCount.dataset == dataset.id)
+                            .tuples())
+        counts = {'accept': 0, 'reject': 0, 'ignore': 0}
+        counts.update(query)
+        return counts
+
+    def upsert_examples(self, rows):
+        """Insert example rows that aren't stored yet, and reuse the IDs of
+        existing rows with the same task hash and content. New rows are
+        unique by task hash and content hash, so a row another process
+        inserts at the same time is reused instead of stored twice.
+
+        rows (list): (input_hash, task_hash, content, created) tuples.
+        RETURNS (list): The example IDs, one per row and in the same order.
+        """
+        stored = {}
+        task_hashes = list(set(row[1] for row in rows))
+        for chunk in chunked(task_hashes, BULK_INSERT_SIZE):
+            query = (Example.select(Example.id, Example.task_hash, Example.content)
+                            .where(Example.task_hash << chunk)
+                            .tuples())
+            for eg_id, task_hash, content in query:
+                stored[(task_hash, blob_bytes(content))] = eg_id
+        new_rows = []
+        for row in rows:
+            key = (row[1], blob_bytes(row[2]))
+            if key not in stored:
+                stored[key] = None
+                new_rows.append(row)
+        new_rows = [row + (get_content_hash(row[2]),) for row in new_rows]
+        self.bulk_insert(Example, [Example.input_hash, Example.task_hash, Example.content,
+                                   Example.created, Example.content_hash],
+                         new_rows, ignore_conflicts=True)
+        # the IDs of the new rows, and of rows another process inserted first
+        new_ids = {}
+        content_hashes = list(set(row[4] for row in new_rows))
+        for chunk in chunked(content_hashes, BULK_INSERT_SIZE):
+            query = (Example.select(Example.id, Example.task_hash, Example.content_hash)
+                            .where(Example.content_hash << chunk))
+            if self.db_id == 'mysql':
+                # reads the latest rows, not the snapshot of the transaction
+                query = query.for_update()
+            for eg_id, task_hash, content_hash in query.tuples():
+                new_ids[(task_hash, content_hash)] = eg_id
+        for row in new_rows:
+            stored[(row[1], blob_bytes(row[2]))] = new_ids[(row[1], row[4])]
+        log("DB: Reusing {} of {} examples".format(len(rows) - len(new_rows), len(rows)))
+        return [stored[(row[1], blob_bytes(row[2]))] for row in rows]
+
+    def bulk_insert(self, model, fields, rows, returning=False, ignore_conflicts=False):
+        """Insert rows with chunked multi-row statements, instead of one
+        query per row. PostgreSQL uses INSERT ... RETURNING, SQLite uses
+        executemany. Other databases fall back to one insert per row.
+
+        model: The model (table) to insert into.
+        fields (list): The model fields, in the same order as the row values.
+        rows (list): Tuples of python values, one per row.
+        returning (bool): Whether to return the IDs of the inserted rows.
+        ignore_conflicts (bool): Skip rows that conflict with a unique index,
+            e.g. because another process inserted them. Can't be combined
+            with returning.
+        RETURNS (list): The IDs of the inserted rows in order, if returning.
+        """
+        if returning and ignore_conflicts:
+            raise ValueError("returning and ignore_conflicts can't be combined")
+        ids = []
+        if not rows:
+            return ids
+        table = model._meta.db_table
+        columns = ', '.join('"{}"'.format(f.db_column) for f in fields)
+        param = self.db.interpolation
+        if self.db_id == 'postgresql':
+            for chunk in chunked(rows, BULK_INSERT_SIZE):
+                values = ', '.join(['({})'.format(', '.join([param] * len(fields)))] * len(chunk))
+                sql = 'INSERT INTO "{}" ({}) VALUES {}'.format(table, columns, values)
+                if ignore_conflicts:
+                    sql += ' ON CONFLICT DO NOTHING'
+                if returning:
+                    sql += ' RETURNING "{}"'.format(model._meta.primary_key.db_column)
+                params = [f.db_value(v) for row in chunk for f, v in zip(fields, row)]
+                cursor = self.db.execute_sql(sql, params, require_commit=False)
+                if returning:
+                    ids.extend(row[0] for row in cursor.fetchall())
+        elif self.db_id == 'sqlite':
+            # SQLite holds a write lock for the whole transaction, so the
+            # rowids of an executemany batch are always consecutive
+            sql = 'INSERT {}INTO "{}" ({}) VALUES ({})'.format(
+                'OR IGNORE ' if ignore_conflicts else '', table, columns,
+                ', '.join([param] * len(fields)))
+            cursor = self.db.get_cursor()
+            for chunk in chunked(rows, BULK_INSERT_SIZE):
+                params = [[f.db_value(v) for f, v in zip(fields, row)] for row in chunk]
+                cursor.executemany(sql, params)
+                if returning:
+                    last_id = cursor.execute('SELECT last_insert_rowid()').fetchone()[0]
+                    ids.extend(range(last_id - len(chunk) + 1, last_id + 1))
+        else:
+            for row in rows:
+                values = dict((f.name, v) for f, v in zip(fields, row))
+                if not ignore_conflicts:
+                    ids.append(model.create(**values).id)
+                    continue
+                try:
+                    with self.db.atomic():
+                        model.create(**values)
+                except orm.IntegrityError:
+                    pass
+        return ids
 
     def unlink(self, dataset):
         """
         dataset (unicode): The name of the dataset to unlink.
         """
         dataset = Dataset.get(Dataset.name == dataset)
-        query = Link.delete().where(Dataset.id == dataset.id)
+        query = Link.delete().where(Link.dataset == dataset.id)
         query.execute()
+        AnswerCount.delete().where(AnswerCount.dataset == dataset.id).execute()
 
     def drop_dataset(self, name):
         """
@@ -329,9 +1070,11 @@ class Database(object):
         dataset = Dataset.get(Dataset.name == name)
         query = Link.delete().where(Link.dataset == dataset.id)
         query.execute()
+        AnswerCount.delete().where(AnswerCount.dataset == dataset.id).execute()
         query = Dataset.delete().where(Dataset.id == dataset.id)
         query.execute()
         self.db.commit()
+        self._datasets.pop(name, None)
         log("DB: Removed dataset '{}'".format(name))
         return True
 
@@ -346,9 +1089,17 @@ class Database(object):
             ids = [ids]
         field = getattr(Example, by)
         ids = list(ids)
+        datasets = list(Dataset.select()
+                               .join(Link)
+                               .join(Example)
+                               .where(field << ids)
+                               .distinct())
         query = Example.delete().where(field << ids)
         query.execute()
         self.db.commit()
+        # the affected datasets are counted again here, not in a request
+        for dataset in datasets:
+            self.recount_answers(dataset)
 
     def save(self):
         log("DB: Saving database")
@@ -0,0 +1,271 @@
+# coding: utf8
+"""Run each job in a child process of a fork server. The worker imports
+prodigy and loads the models of the configured projects once, and the
+children share those pages copy-on-write, so a job only pays for the memory
+it changes, e.g. by updating the weights of its model. A crashing job takes
+down its own process only.
+
+The fork server is forked from the worker process right after it loaded
+the models, before it starts any thread, and never starts one itself. A
+process forked while another thread holds a lock, e.g. of the logging
+module, a connection pool or the RPC server, would wait for it forever, as
+only the forking thread runs in the child.
+
+The worker asks the fork server for a job process with {"job_id": ...,
+"args": [...]}, and gets the worker's end of the job's socket pair and then
+{"pid": ...}. It talks to the job with the same frames as app.rpc: the job
+sends {"uid": ...} once it's ready, then answers each {"method": ...,
+"args": [...]} with {"result": ...} or {"error": ...}.
+"""
+from __future__ import unicode_literals
+
+import os
+import array
+import select
+import signal
+import socket
+import threading
+from celery.utils.log import get_logger
+from app.rpc import send_frame, recv_frame, RPCError, JOB_METHODS
+
+
+logger = get_logger(__name__)
+_FORKSERVER = None
+
+
+def preload(projects, models, data_dir):
+    """Import prodigy and load the models of the projects that don't depend
+    on the user or the job, before any job process is forked.
+
+    projects (dict): The project settings, keyed by project id.
+    models (app.models.ModelRegistry): The registry to load the models into.
+    data_dir (unicode): The data directory, for '{data_dir}' in paths.
+    """
+    import prodigy  # noqa: F401
+    for project_id, settings in projects.items():
+        name = settings['recipe_args'].get('spacy_model')
+        if not name or '{user_id}' in name or '{job_id}' in name:
+            continue
+        name = name.replace('{data_dir}', data_dir)
+        try:
+            models.acquire(name)
+        except (IOError, OSError) as e:
+            logger.warning('MODEL "{}" OF PROJECT "{}" NOT PRELOADED: {}'.format(name, project_id, e))
+    logger.warning('PRELOADED {} MODELS'.format(len(models.models)))
+
+
+def send_fd(sock, fd):
+    sock.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))])
+
+
+def recv_fd(sock):
+    fds = array.array('i')
+    data, ancdata, _, _ = sock.recvmsg(1, socket.CMSG_SPACE(fds.itemsize))
+    if not data:
+        raise socket.error('connection closed by fork server')
+    for level, kind, value in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(value[:fds.itemsize])
+    if not fds:
+        raise socket.error('no socket received from fork server')
+    return fds[0]
+
+
+class ForkServer(object):
+    def __init__(self, make_job):
+        """Fork the fork server. Must be called while the process runs no
+        other thread.
+
+        make_job (callable): Called in a new job process with the job id and
+            the arguments of the request, creates the job.
+        """
+        self.lock = threading.Lock()
+        self.sock, server = socket.socketpair()
+        self.pid = os.fork()
+        if self.pid == 0:
+            self.sock.close()
+            serve_forks(server, make_job)
+        server.close()
+        logger.warning('FORK SERVER RUNNING IN PROCESS {}'.format(self.pid))
+
+    def spawn(self, job_id, args):
+        """Fork a job process.
+
+        job_id (unicode): The job id.
+        args (list): More arguments of make_job, serializable to JSON.
+        RETURNS (tuple): The pid of the job process and the worker's end of
+            its socket pair.
+        """
+        with self.lock:
+            try:
+                send_frame(self.sock, {'job_id': job_id, 'args': list(args)})
+                fd = recv_fd(self.sock)
+                reply = recv_frame(self.sock)
+            except (socket.error, ValueError) as e:
+                raise RPCError('fork server is gone: {}'.format(e))
+        sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(fd)
+        if reply is None:
+            sock.close()
+            raise RPCError('fork server is gone')
+        return reply['pid'], sock
+
+
+def start_forkserver(make_job):
+    """Start the fork server of this process, see ForkServer.
+
+    make_job (callable): Creates the job in a job process.
+    """
+    global _FORKSERVER
+    _FORKSERVER = ForkServer(make_job)
+
+
+class JobProcess(object):
+    def __init__(self, job_id, args):
+        """Start a job in a process forked by the fork server and forward
+        the job calls to it. Has the same methods as app.tasks.ProdigyJob.
+
+        job_id (unicode): The job id.
+        args (list): More arguments of the fork server's make_job.
+        """
+        if _FORKSERVER is None:
+            raise RuntimeError('no fork server, start_forkserver must be called '
+                               'before the worker starts any thread')
+        self.id = job_id
+        self.lock = threading.Lock()
+        self.pid, self.sock = _FORKSERVER.spawn(job_id, args)
+        reply = self.recv()
+        if 'error' in reply:
+            self.close()
+            raise RPCError(reply['error'])
+        self.uid = reply['uid']
+        logger.warning('JOB "{}" RUNNING IN PROCESS {}'.format(job_id, self.pid))
+
+    def __getattr__(self, method):
+        if method not in JOB_METHODS:
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
+
+    @property
+    def alive(self):
+        return self.sock is not None
+
+    def call(self, method, *args):
+        if not self.alive:
+            raise RPCError('process of job "{}" is gone'.format(self.id))
+        with self.lock:
+            try:
+                send_frame(self.sock, {'method': method, 'args': list(args)})
+                reply = self.recv()
+            except (socket.error, ValueError) as e:
+                self.close()
+                raise RPCError('process of job "{}" is gone: {}'.format(self.id, e))
+        if 'error' in reply:
+            raise RPCError(reply['error'])
+        return reply['result']
+
+    def hibernate(self, path):
+        """Save the state of the job in the child, see
+        app.tasks.ProdigyJob.hibernate. The child can be closed after.
+        """
+        return self.call('hibernate', path)
+
+    def recv(self):
+        reply = recv_frame(self.sock)
+        if reply is None:
+            raise socket.error('connection closed by job process')
+        return reply
+
+    def close(self):
+        """Stop the child process. It exits once its socket is closed, and
+        the fork server reaps it.
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def serve_forks(sock, make_job):
+    """Fork a job process for each request of the worker, and reap the job
+    processes that exited, until the worker closes the socket. Never
+    returns.
+    """
+    status = 0
+    jobs = {}
+    try:
+        # the worker stops on SIGINT and closes the socket
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        while True:
+            readable, _, _ = select.select([sock], [], [], 1.0)
+            reap(jobs)
+            if not readable:
+                continue
+            message = recv_frame(sock)
+            if message is None:
+                break
+            job_id = message['job_id']
+            parent, child = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                sock.close()
+                parent.close()
+                run_child(child, lambda: make_job(job_id, *message['args']))
+            child.close()
+            jobs[pid] = job_id
+            send_fd(sock, parent.fileno())
+            parent.close()
+            send_frame(sock, {'pid': pid})
+    except BaseException:
+        logger.exception('FORK SERVER CRASHED')
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def reap(jobs):
+    """Reap the job processes that exited.
+
+    jobs (dict): The job ids of the running job processes, keyed by pid.
+    """
+    while jobs:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            return
+        job_id = jobs.pop(pid, None)
+        if status:
+            logger.error('JOB "{}" PROCESS {} EXITED WITH STATUS {}'.format(job_id, pid, status))
+
+
+def run_child(sock, make_job):
+    """Create the job and serve its calls until the worker closes the
+    socket. Never returns.
+    """
+    status = 0
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            job = make_job()
+        except Exception as e:
+            logger.exception('JOB PROCESS FAILED TO START')
+            send_frame(sock, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+        send_frame(sock, {'uid': job.uid})
+        while True:
+            message = recv_frame(sock)
+            if message is None:
+                break
+            try:
+                reply = {'result': getattr(job, message['method'])(*message['args'])}
+            except Exception as e:
+                logger.exception('JOB "{}" CALL {} FAILED'.format(job.id, message['method']))
+                reply = {'error': '{}: {}'.format(type(e).__name__, e)}
+            send_frame(sock, reply)
+        if getattr(job, 'journal', None) is not None:
+            job.journal.flush()
+    except BaseException:
+        logger.exception('JOB PROCESS CRASHED')
+        status = 1
+    finally:
+        # skip the cleanup of the process we were forked from
+        os._exit(status)
@@ -0,0 +1,175 @@
+# coding: utf8
+from __future__ import unicode_literals
+
+import os
+import threading
+import ujson
+from celery.utils.log import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class AnswerJournal(object):
+    def __init__(self, path, flush, batch_size=50, interval=5.0):
+        """Buffer answers in a local journal file and save them in batches
+        from a background thread. Answers are fsync'd to the journal before
+        they're acknowledged, and answers left in the journal by a previous
+        run are loaded again, so they're saved on the next flush.
+
+        path (unicode): Path of the journal file.
+        flush (callable): Called with a list of answers and the names of the
+            datasets to add them to, to save them. Answers from the journal
+            of a previous run may already be saved, if it stopped before it
+            removed them from the journal, so it should skip those.
+        batch_size (int): Number of buffered answers that triggers a flush.
+        interval (float): Maximum number of seconds answers stay buffered.
+        """
+        self.path = path
+        self.flush_answers = flush
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.pending = self.read()
+        if self.pending:
+            logger.warning('JOURNAL "{}" HAS {} UNSAVED ANSWERS'.format(path, len(self)))
+        self.file = open(path, 'ab')
+        self.thread = threading.Thread(target=self.run, name='journal-flusher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        """
+        RETURNS (int): The number of answers that aren't saved yet.
+        """
+        return sum(len(answers) for _, answers in self.pending)
+
+    def read(self):
+        """
+        RETURNS (list): The batches in the journal file, as tuples of the
+            dataset names and the answers.
+        """
+        batches = []
+        if not os.path.exists(self.path):
+            return batches
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    batch = ujson.loads(line)
+                except ValueError:
+                    # a batch cut off while it was written was never acknowledged
+                    logger.warning('JOURNAL "{}" ENDS WITH A PARTIAL BATCH'.format(self.path))
+                    break
+                batches.append((tuple(batch['datasets']), batch['answers']))
+        return batches
+
+    def dump(self, datasets, answers):
+        batch = {'datasets': list(datasets), 'answers': answers}
+        return ujson.dumps(batch, escape_forward_slashes=False).encode('utf8') + b'\n'
+
+    def append(self, answers, datasets):
+        """Write answers to the journal. Returns once they're on disk.
+
+        answers (list): The annotated tasks.
+        datasets (list): The names of the datasets to add them to.
+        """
+        answers = list(answers)
+        line = self.dump(datasets, answers)
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending.append((tuple(datasets), answers))
+        if len(self) >= self.batch_size:
+            self.wakeup.set()
+
+    def flush(self):
+        """Save the buffered answers and remove them from the journal. If
+        saving fails, the answers stay buffered and are retried later.
+
+        RETURNS (int): The number of answers saved.
+        """
+        with self.flush_lock:
+            with self.lock:
+                batch = self.pending
+                self.pending = []
+            if not batch:
+                return 0
+            # consecutive batches for the same datasets are saved together
+            groups = []
+            for datasets, answers in batch:
+                if groups and groups[-1][0] == datasets:
+                    groups[-1][1].extend(answers)
+                else:
+                    groups.append((datasets, list(answers)))
+            try:
+                for datasets, answers in groups:
+                    self.flush_answers(answers, datasets)
+            except Exception:
+                # the groups saved before are skipped when they're retried
+                with self.lock:
+                    self.pending = batch + self.pending
+                raise
+            with self.lock:
+                self.rewrite()
+        return sum(len(answers) for _, answers in groups)
+
+    def rewrite(self):
+        """Replace the journal file with the answers that are still pending.
+        Must be called with the lock held.
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for datasets, answers in self.pending:
+                f.write(self.dump(datasets, answers))
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.rename(tmp_path, self.path)
+        self.file = open(self.path, 'ab')
+
+    def close(self):
+        """Save the buffered answers and stop the background thread."""
+        self.flush()
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        with self.lock:
+            self.file.close()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if self.closed:
+                return
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('JOURNAL "{}" FAILED TO FLUSH'.format(self.path))
+
+
+class JournaledDatabase(object):
+    def __init__(self, db, journal):
+        """Stand in for the database of a controller with write-behind
+        answers. The controller receives the answers as usual, so its model
+        is updated and the progress counted right away, but the examples it
+        adds go to the journal, which saves them to the database later.
+        Everything else is passed on to the database.
+
+        db (Database): The database.
+        journal (AnswerJournal): The journal of the job.
+        """
+        self.db = db
+        self.journal = journal
+
+    def add_examples(self, examples, datasets=tuple()):
+        self.journal.append(examples, datasets)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
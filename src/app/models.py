@@ -0,0 +1,271 @@
+# coding: utf8
+from __future__ import unicode_literals
+
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from celery.utils.log import get_logger
+
+
+logger = get_logger(__name__)
+
+# Recipes that update the weights of their model while annotating. Jobs of
+# these recipes get a private copy of the model instead of the shared one.
+UPDATING_RECIPES = ('ner.teach', 'textcat.teach', 'terms.teach', 'pos.teach',
+                    'dep.teach', 'ner.batch-train', 'textcat.batch-train')
+# Memory limit, usage and the reclaimable cache in memory.stat of this
+# process's cgroup, for cgroup v2 and v1
+CGROUP_MEMORY_FILES = [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current',
+                        'inactive_file'),
+                       ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                        '/sys/fs/cgroup/memory/memory.usage_in_bytes', 'total_inactive_file')]
+
+
+def get_rss():
+    """
+    RETURNS (int): The resident memory of this process in bytes, or 0 if it
+        can't be read.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def get_tree_rss(pid=None):
+    """
+    pid (int): The process. Defaults to this process.
+    RETURNS (int): The resident memory of the process and all processes it
+        started, e.g. pool processes and forked jobs, in bytes.
+    """
+    pid = pid or os.getpid()
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                # the command in parentheses can contain spaces
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    rss = 0
+    todo = [pid]
+    while todo:
+        pid = todo.pop()
+        try:
+            with open('/proc/{}/statm'.format(pid)) as f:
+                rss += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (IOError, OSError, ValueError):
+            pass
+        todo.extend(children.get(pid, []))
+    return rss
+
+
+def get_cgroup_free_memory():
+    """
+    RETURNS (int): The memory left under the memory limit of this process's
+        cgroup in bytes, e.g. of the worker's container, not counting
+        reclaimable file cache, or None if there's no limit.
+    """
+    for limit_file, usage_file, cache_key in CGROUP_MEMORY_FILES:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+            with open(usage_file) as f:
+                usage = int(f.read())
+        except (IOError, OSError, ValueError):
+            continue
+        # cgroup v1 reports no limit as a huge number instead of 'max'
+        if limit == 'max' or int(limit) >= 2 ** 60:
+            return None
+        stat_file = os.path.join(os.path.dirname(usage_file), 'memory.stat')
+        try:
+            with open(stat_file) as f:
+                for line in f:
+                    key, value = line.split()
+                    if key == cache_key:
+                        usage -= int(value)
+        except (IOError, OSError, ValueError):
+            pass
+        return max(int(limit) - usage, 0)
+    return None
+
+
+def get_free_memory(budget=0):
+    """The memory this worker has left. Workers that share a machine each
+    report their own: the room under the memory limit of their cgroup, e.g.
+    their container, and under their budget, if they have one. Otherwise
+    it's the memory available on the machine.
+
+    budget (int): Memory the worker may use in bytes, including its pool
+        processes and jobs, or 0 for no budget.
+    RETURNS (int): The memory left to the worker in bytes, or 0 if it can't
+        be read.
+    """
+    free = []
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    free.append(int(line.split()[1]) * 1024)
+    except (IOError, OSError, ValueError):
+        pass
+    cgroup = get_cgroup_free_memory()
+    if cgroup is not None:
+        free.append(cgroup)
+    if budget:
+        free.append(max(budget - get_tree_rss(), 0))
+    return min(free) if free else 0
+
+
+def get_disk_size(path):
+    """
+    path (unicode): A model directory.
+    RETURNS (int): The size of the files in the directory in bytes.
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+class ModelRegistry(object):
+    def __init__(self, budget=0):
+        """Share loaded spaCy pipelines between the jobs of a worker. Models
+        are refcounted by the jobs that use them, and models no job uses are
+        evicted, least recently used first, once the loaded models take more
+        memory than the budget.
+
+        budget (int): Memory budget in MB for loaded models. 0 for no limit.
+        """
+        self.budget = budget * 1024 * 1024
+        self.models = OrderedDict()
+        self.lock = threading.RLock()
+        # per model, held while it loads, so models load in parallel but
+        # each model only once
+        self.loading = {}
+        self.local = threading.local()
+        self.spacy_load = None
+
+    def __contains__(self, name):
+        return name in self.models
+
+    @property
+    def size(self):
+        """
+        RETURNS (int): The estimated memory of the loaded models in bytes.
+        """
+        return sum(entry['size'] for entry in self.models.values())
+
+    def get(self, name):
+        """Get a shared model without holding a reference, e.g. for a single
+        prediction. The model can be evicted once the call is done.
+
+        name (unicode): The model name or path.
+        RETURNS (spacy.language.Language): The loaded model.
+        """
+        nlp = self.acquire(name)
+        self.release(name)
+        return nlp
+
+    def acquire(self, name):
+        """Get a shared model and hold a reference to it.
+
+        name (unicode): The model name or path.
+        RETURNS (spacy.language.Language): The loaded model.
+        """
+        with self.lock:
+            loading = self.loading.setdefault(name, threading.Lock())
+        with loading:
+            with self.lock:
+                if name in self.models:
+                    self.models.move_to_end(name)
+                    self.models[name]['refs'] += 1
+                    return self.models[name]['nlp']
+            # the size is an estimate, other threads may allocate meanwhile
+            rss = get_rss()
+            nlp = self.load(name)
+            size = get_rss() - rss
+            if size <= 0 and os.path.isdir(name):
+                size = get_disk_size(name)
+            logger.warning('MODEL "{}" LOADED ({:.0f} MB)'.format(name, size / 1024 / 1024))
+            with self.lock:
+                self.models[name] = {'nlp': nlp, 'refs': 1, 'size': max(size, 0)}
+                self.evict()
+                return nlp
+
+    def release(self, name):
+        """Drop a reference to a shared model.
+
+        name (unicode): The model name or path.
+        """
+        with self.lock:
+            if name in self.models:
+                self.models[name]['refs'] = max(self.models[name]['refs'] - 1, 0)
+                self.evict()
+
+    def evict(self):
+        """Unload unreferenced models, least recently used first, until the
+        loaded models fit the budget.
+        """
+        if not self.budget:
+            return
+        with self.lock:
+            size = self.size
+            for name in list(self.models):
+                if size <= self.budget:
+                    break
+                if self.models[name]['refs'] == 0:
+                    size -= self.models.pop(name)['size']
+                    logger.warning('MODEL "{}" EVICTED'.format(name))
+
+    def load(self, name, **overrides):
+        import spacy
+        load = self.spacy_load or spacy.load
+        return load(name, **overrides)
+
+    @contextmanager
+    def capture(self, shared=True):
+        """Route the spacy.load calls made by the current thread, e.g. by a
+        recipe, through the registry while the context is active.
+
+        shared (bool): Whether to use shared models. If False, models are
+            loaded as private copies that the caller can update.
+        YIELDS (dict): The names of the shared models acquired ('shared'),
+            which the caller should release when it's done with them, the
+            private copies loaded ('private'), keyed by name, and all models
+            loaded, shared or not ('loaded'), keyed by name.
+        """
+        import spacy
+        with self.lock:
+            if self.spacy_load is None:
+                self.spacy_load = spacy.load
+                spacy.load = self._load_in_context
+        models = {'shared': [], 'private': {}, 'loaded': {}}
+        self.local.models = models
+        self.local.shared = shared
+        self.local.active = True
+        try:
+            yield models
+        finally:
+            self.local.active = False
+            self.local.models = None
+
+    def _load_in_context(self, name, **overrides):
+        if not getattr(self.local, 'active', False) or overrides:
+            return self.spacy_load(name, **overrides)
+        if not self.local.shared:
+            logger.warning('MODEL "{}" LOADED AS A PRIVATE COPY'.format(name))
+            nlp = self.spacy_load(name)
+            self.local.models['private'][name] = nlp
+            self.local.models['loaded'][name] = nlp
+            return nlp
+        nlp = self.acquire(name)
+        self.local.models['shared'].append(name)
+        self.local.models['loaded'][name] = nlp
+        return nlp
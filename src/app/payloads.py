@@ -0,0 +1,94 @@
+# coding: utf8
+"""Encode the JSON responses of the job routes, e.g. batches of questions
+with the tokens of every task, with orjson if it's installed and otherwise
+ujson, gzip them for clients that accept it, and keep statistics of their
+size and the time it took to encode them per route.
+"""
+from __future__ import unicode_literals
+
+import json
+import time
+import zlib
+import threading
+import ujson
+from collections import namedtuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+Payload = namedtuple('Payload', ['body', 'encoding', 'size', 'seconds'])
+
+
+def dumps(obj):
+    """
+    obj: The object to encode.
+    RETURNS (bytes): The object as compact UTF-8 JSON.
+    """
+    try:
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf8')
+    except (TypeError, ValueError, OverflowError):
+        # e.g. keys that aren't strings, which only json supports
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+
+
+def encode_payload(obj, gzip=False, min_size=1024, level=3):
+    """
+    obj: The object to encode.
+    gzip (bool): Whether the client accepts gzip.
+    min_size (int): Smaller payloads (in bytes) aren't compressed.
+    level (int): The gzip compression level. Higher levels take much
+        longer for a few percent smaller batches.
+    RETURNS (Payload): The body, its 'gzip' encoding or None, the size of
+        the JSON in bytes and the seconds it took to encode and compress it.
+    """
+    start = time.time()
+    body = dumps(obj)
+    size = len(body)
+    encoding = None
+    if gzip and size >= min_size:
+        # wbits 31 writes a gzip header, like the gzip module but faster
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        body = compressor.compress(body) + compressor.flush()
+        encoding = 'gzip'
+    return Payload(body, encoding, size, time.time() - start)
+
+
+class PayloadStats(object):
+    def __init__(self):
+        """Statistics of the payloads sent by each route."""
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def record(self, route, payload):
+        """
+        route (unicode): The route, e.g. 'get_questions'.
+        payload (Payload): The payload it sent.
+        """
+        with self.lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = {'calls': 0, 'json_bytes': 0, 'sent_bytes': 0,
+                                              'encode_seconds': 0.0, 'max_json_bytes': 0}
+            stats['calls'] += 1
+            stats['json_bytes'] += payload.size
+            stats['sent_bytes'] += len(payload.body)
+            stats['encode_seconds'] += payload.seconds
+            stats['max_json_bytes'] = max(stats['max_json_bytes'], payload.size)
+
+    def get(self):
+        """
+        RETURNS (dict): The statistics of each route, with the totals and
+            the averages per call of the payload sizes and encode times.
+        """
+        with self.lock:
+            routes = {route: dict(stats) for route, stats in self.routes.items()}
+        for stats in routes.values():
+            stats['avg_json_bytes'] = stats['json_bytes'] / stats['calls']
+            stats['avg_sent_bytes'] = stats['sent_bytes'] / stats['calls']
+            stats['avg_encode_ms'] = stats['encode_seconds'] * 1000 / stats['calls']
+        return routes
@@ -0,0 +1,71 @@
+# coding: utf8
+"""Choose the worker that runs a new job, from the jobs and models each
+worker already holds and the memory it has left.
+"""
+from __future__ import unicode_literals
+
+from collections import namedtuple
+from app.models import UPDATING_RECIPES
+
+
+WorkerLoad = namedtuple('WorkerLoad', ['name', 'free_memory', 'jobs', 'models'])
+
+
+def get_shared_model(settings):
+    """
+    settings (dict): The project settings.
+    RETURNS (unicode): The model the jobs of the project share in a worker,
+        or None if every job loads its own copy.
+    """
+    name = settings['recipe_args'].get('spacy_model')
+    if not name or '{user_id}' in name or '{job_id}' in name:
+        return None
+    if not settings.get('shared_model', settings['recipe'] not in UPDATING_RECIPES):
+        return None
+    return name
+
+
+def get_worker_loads(workers, projects):
+    """Combine what the workers report into their load.
+
+    workers (dict): The workers in the job registry, keyed by name, e.g.
+        {'celery@a': {'free_memory': 2147483648, 'jobs': [...]}}.
+    projects (dict): The project settings, keyed by project id.
+    RETURNS (list): The WorkerLoad of each worker.
+    """
+    loads = []
+    for worker, reply in workers.items():
+        jobs = reply.get('jobs', [])
+        models = set()
+        for job_id in jobs:
+            # job ids are 'prodigy.{project_id}.{user_id}'
+            project_id = job_id.split('.')[1]
+            if project_id in projects:
+                models.add(get_shared_model(projects[project_id]))
+        models.discard(None)
+        loads.append(WorkerLoad(worker, reply.get('free_memory', 0), len(jobs), models))
+    return loads
+
+
+def place_job(workers, model, footprint, max_jobs=0):
+    """Choose the worker for a new job. Workers the job fits on come first,
+    then workers that already hold its model, so it doesn't have to be
+    loaded again. Between those, jobs are packed onto the worker with the
+    least memory left that still fits, to keep room for large models on the
+    others, and the worker with fewer jobs wins a tie.
+
+    workers (list): The WorkerLoad of each worker.
+    model (unicode): The shared model of the job, or None.
+    footprint (int): Estimated memory of the job's model in bytes.
+    max_jobs (int): Maximum number of jobs per worker, 0 for no limit.
+    RETURNS (WorkerLoad): The chosen worker, or None if there are none.
+    """
+    def key(worker):
+        holds = model is not None and model in worker.models
+        left = worker.free_memory - (0 if holds else footprint)
+        full = left < 0 or (max_jobs and worker.jobs >= max_jobs)
+        # a worker that's full gets the job only if all are, and then the
+        # one with the most memory left
+        return (bool(full), not holds, -left if full else left, worker.jobs)
+
+    return min(workers, key=key) if workers else None
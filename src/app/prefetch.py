@@ -0,0 +1,101 @@
+# coding: utf8
+from __future__ import unicode_literals
+
+import threading
+from collections import deque
+from celery.utils.log import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class PrefetcherClosed(Exception):
+    """Raised when questions are requested from a closed prefetcher, e.g.
+    of a job that hibernated while the request waited."""
+
+
+class QuestionPrefetcher(object):
+    def __init__(self, fetch, depth=2):
+        """Keep batches of questions ready, fetched by a background thread,
+        so scoring and sorting the stream happens between requests instead
+        of while the annotator waits. The questions of a ready batch are
+        already taken from the stream, so batches are never dropped: with a
+        recipe that updates its model, up to `depth` batches are scored by
+        the model as it was before the latest answers.
+
+        fetch (callable): Returns the next batch of questions.
+        depth (int): Number of batches to keep ready.
+        """
+        self.fetch = fetch
+        self.depth = depth
+        self.batches = deque()
+        self.cond = threading.Condition()
+        self.exhausted = False
+        self.closed = False
+        self.hits = 0
+        self.misses = 0
+        self.thread = threading.Thread(target=self.run, name='question-prefetcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def stats(self):
+        """
+        RETURNS (dict): How many requests found a batch ready ('hits') and
+            how many had to wait for one because the buffer was empty.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'ready': len(self.batches)}
+
+    def get(self):
+        """Take the next batch, waiting for one if none is ready. Raises the
+        error if fetching the batch failed, and PrefetcherClosed if the
+        prefetcher is closed.
+
+        RETURNS (list): The questions. Empty once the stream is exhausted.
+        """
+        with self.cond:
+            if self.batches:
+                self.hits += 1
+            else:
+                self.misses += 1
+                logger.info('PREFETCH BUFFER EMPTY ({} of {} requests)'
+                            .format(self.misses, self.hits + self.misses))
+            while not self.batches and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                raise PrefetcherClosed('no questions, the prefetcher is closed')
+            batch = self.batches[0]
+            if batch:
+                self.batches.popleft()
+                self.cond.notify_all()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def close(self):
+        """Stop the background thread and drop the ready batches."""
+        with self.cond:
+            self.closed = True
+            self.batches.clear()
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.closed and (self.exhausted or len(self.batches) >= self.depth):
+                    self.cond.wait()
+                if self.closed:
+                    return
+            try:
+                batch = self.fetch()
+            except Exception as e:
+                logger.exception('PREFETCH FAILED')
+                batch = e
+            with self.cond:
+                if self.closed:
+                    return
+                if not batch:
+                    # the stream is exhausted, the empty batch stays ready
+                    self.exhausted = True
+                self.batches.append(batch)
+                self.cond.notify_all()
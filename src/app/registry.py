@@ -0,0 +1,136 @@
+# coding: utf8
+"""Which worker runs which job, kept in Redis so the web app can look it up
+without broadcasting to all workers. Workers write it with heartbeats, and
+every key expires, so the jobs of a worker that died disappear with it.
+
+    prodigy:worker:<name>       {"free_memory": ...}, refreshed by the worker
+    prodigy:workers             sorted set of the workers, by last heartbeat
+    prodigy:procs:<name>        sorted set of the pids of a worker's processes
+                                that run jobs, by last heartbeat
+    prodigy:jobs:<name>:<pid>   set of the jobs of a worker process
+    prodigy:job:<job_id>        {"worker": ..., "address": ...}
+
+The processes of a prefork worker share its node name, so each reports the
+jobs it runs in a set of its own.
+"""
+from __future__ import unicode_literals
+
+import os
+import time
+import ujson
+
+
+PREFIX = 'prodigy:'
+
+
+class JobRegistry(object):
+    def __init__(self, url, ttl=30):
+        """
+        url (unicode): The Redis URL, e.g. 'redis://localhost:6379/0'.
+        ttl (int): Seconds until the keys of a worker that stopped sending
+            heartbeats expire.
+        """
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+
+    def beat_worker(self, name, free_memory):
+        """Report that a worker is alive.
+
+        name (unicode): The worker's node name, e.g. 'celery@host'.
+        free_memory (int): The memory available to the worker in bytes.
+        """
+        pipe = self.redis.pipeline()
+        pipe.set(PREFIX + 'worker:' + name, ujson.dumps({'free_memory': free_memory}), ex=self.ttl)
+        # the same command in every version of redis-py
+        pipe.execute_command('ZADD', PREFIX + 'workers', time.time(), name)
+        pipe.execute()
+
+    def beat_jobs(self, name, job_ids, address=None, pid=None):
+        """Report the jobs a worker process runs.
+
+        name (unicode): The worker's node name.
+        job_ids (list): The jobs the process runs.
+        address (unicode): The RPC address of the jobs, or None.
+        pid (int): The process id. Defaults to the calling process.
+        """
+        pid = os.getpid() if pid is None else pid
+        key = '{}jobs:{}:{}'.format(PREFIX, name, pid)
+        value = ujson.dumps({'worker': name, 'address': address})
+        pipe = self.redis.pipeline()
+        # only this process writes its set
+        pipe.delete(key)
+        for job_id in job_ids:
+            pipe.set(PREFIX + 'job:' + job_id, value, ex=self.ttl)
+        if job_ids:
+            pipe.sadd(key, *job_ids)
+            pipe.expire(key, self.ttl)
+        pipe.execute_command('ZADD', PREFIX + 'procs:' + name, time.time(), pid)
+        pipe.expire(PREFIX + 'procs:' + name, self.ttl)
+        pipe.execute()
+
+    def claim_job(self, job_id, name):
+        """Record that a job is placed on a worker, unless it already runs.
+        The claim lasts until the worker reports the job, as long as
+        loading its model may take.
+
+        job_id (unicode): The job id.
+        name (unicode): The worker's node name.
+        RETURNS (bool): Whether the job was claimed. False if another
+            request placed it first.
+        """
+        value = ujson.dumps({'worker': name, 'address': None})
+        return bool(self.redis.set(PREFIX + 'job:' + job_id, value, ex=self.ttl * 10, nx=True))
+
+    def release_job(self, job_id):
+        """Forget a job, e.g. because it failed to start.
+
+        job_id (unicode): The job id.
+        """
+        self.redis.delete(PREFIX + 'job:' + job_id)
+
+    def get_job(self, job_id):
+        """
+        job_id (unicode): The job id.
+        RETURNS (dict): The 'worker' running the job and its RPC 'address',
+            or None if the job doesn't run on a live worker.
+        """
+        value = self.redis.get(PREFIX + 'job:' + job_id)
+        if value is None:
+            return None
+        job = ujson.loads(value)
+        if not self.redis.exists(PREFIX + 'worker:' + job['worker']):
+            self.release_job(job_id)
+            return None
+        return job
+
+    def get_workers(self):
+        """
+        RETURNS (dict): The live workers, keyed by name, with their
+            'free_memory' and their 'jobs'.
+        """
+        key = PREFIX + 'workers'
+        self.redis.zremrangebyscore(key, 0, time.time() - self.ttl)
+        names = [name.decode('utf8') for name in self.redis.zrange(key, 0, -1)]
+        if not names:
+            return {}
+        pipe = self.redis.pipeline()
+        for name in names:
+            pipe.get(PREFIX + 'worker:' + name)
+            pipe.zrangebyscore(PREFIX + 'procs:' + name, time.time() - self.ttl, '+inf')
+        replies = pipe.execute()
+        workers = {}
+        pipe = self.redis.pipeline()
+        for name, value, pids in zip(names, replies[::2], replies[1::2]):
+            if value is None:
+                continue
+            workers[name] = ujson.loads(value)
+            keys = ['{}jobs:{}:{}'.format(PREFIX, name, pid.decode('utf8')) for pid in pids]
+            if keys:
+                pipe.sunion(*keys)
+        jobs = iter(pipe.execute())
+        for name, value, pids in zip(names, replies[::2], replies[1::2]):
+            if value is not None:
+                job_ids = next(jobs) if pids else []
+                workers[name]['jobs'] = [job_id.decode('utf8') for job_id in job_ids]
+        return workers
@@ -0,0 +1,174 @@
+# coding: utf8
+"""Resume the source of a job where its annotator left off, instead of
+reading it from the top and filtering out the tasks that are already in the
+dataset, which takes longer the more tasks are annotated.
+
+The recipe reads the source through a pipe, fed by a thread that starts at
+the saved byte offset and adds the offset of its line to each task. The
+recipe reads ahead of the annotator, e.g. to prefetch batches, so the
+offsets of the questions sent out are kept until they're answered. After
+answers are saved, the offset of the first line with a question that's
+still open, or else of the last answered line, is saved with a hash of
+that line, so a source that changed since is read from the top.
+"""
+from __future__ import unicode_literals
+
+import os
+import select
+import threading
+import ujson
+from hashlib import md5
+from prodigy.util import TASK_HASH_ATTR
+from celery.utils.log import get_logger
+
+
+logger = get_logger(__name__)
+OFFSET_KEY = '_source_offset'
+
+
+class ResumableSource(object):
+    def __init__(self, path, state_path):
+        """
+        path (unicode): Path of the JSONL source.
+        state_path (unicode): Path of the file that keeps the offset.
+        """
+        self.path = path
+        self.state_path = state_path
+        if not os.path.exists(os.path.dirname(state_path)):
+            os.makedirs(os.path.dirname(state_path))
+        self.offset = self.load()
+        # offsets of the questions sent out, keyed by task hash
+        self.open = {}
+        self.answered = None
+        self.stopped = threading.Event()
+        read_fd, write_fd = os.pipe()
+        # the feeder waits for the recipe to read, so it can stop while the
+        # pipe is full
+        os.set_blocking(write_fd, False)
+        self.fd = read_fd
+        self.thread = threading.Thread(target=self.feed, args=(write_fd,), name='source-feeder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def source(self):
+        """
+        RETURNS (unicode): The path the recipe should read the source from.
+        """
+        return '/dev/fd/{}'.format(self.fd)
+
+    def load(self):
+        """
+        RETURNS (int): The saved offset, or 0 if there's none or the source
+            changed since it was saved.
+        """
+        if not os.path.exists(self.state_path):
+            return 0
+        with open(self.state_path) as f:
+            state = ujson.load(f)
+        if self.hash_line(state['offset']) != state['hash']:
+            logger.warning('SOURCE "{}" CHANGED, READING IT FROM THE TOP'.format(self.path))
+            return 0
+        logger.info('SOURCE "{}" RESUMED AT BYTE {}'.format(self.path, state['offset']))
+        return state['offset']
+
+    def hash_line(self, offset):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return md5(f.readline()).hexdigest()
+
+    def feed(self, fd):
+        offset = self.offset
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    try:
+                        task = ujson.loads(line) if line.strip() else None
+                    except ValueError:
+                        # passed on as it is, so the recipe reports it
+                        task = None
+                    data = line
+                    if isinstance(task, dict):
+                        task[OFFSET_KEY] = offset
+                        data = ujson.dumps(task, escape_forward_slashes=False).encode('utf8') + b'\n'
+                    if not self.write(fd, data):
+                        return
+                    offset += len(line)
+        except (IOError, OSError):
+            # the recipe stopped reading
+            pass
+        finally:
+            # the recipe reads to the end of the source
+            os.close(fd)
+
+    def write(self, fd, data):
+        """Write to the pipe, waiting while it's full.
+
+        fd (int): The write end of the pipe.
+        data (bytes): The data to write.
+        RETURNS (bool): Whether the data was written, False if the source
+            was closed first.
+        """
+        data = memoryview(data)
+        while data:
+            if self.stopped.is_set():
+                return False
+            _, writable, _ = select.select([], [fd], [], 0.5)
+            if writable:
+                try:
+                    data = data[os.write(fd, data):]
+                except BlockingIOError:
+                    pass
+        return True
+
+    def sent(self, questions):
+        """Keep the offsets of questions sent out, until they're answered.
+
+        questions (list): The questions of a batch.
+        """
+        for task in questions:
+            if OFFSET_KEY in task:
+                self.open[task.get(TASK_HASH_ATTR)] = task[OFFSET_KEY]
+
+    def get_offset(self, answers):
+        """Remove the offsets from answers, so they're not saved with them.
+
+        answers (list): The annotated tasks.
+        RETURNS (int): The offset to resume from once the answers are saved:
+            of the first line with a question that's still open, or if all
+            are answered, of the last line answered. None if it's unknown.
+        """
+        for task in answers:
+            if OFFSET_KEY in task:
+                offset = task.pop(OFFSET_KEY)
+                self.open.pop(task.get(TASK_HASH_ATTR), None)
+                self.answered = max(offset, self.answered or 0)
+        if self.open:
+            return min(self.open.values())
+        return self.answered
+
+    def save(self, offset):
+        """Save the offset to resume from, once the answers up to it are
+        saved. The line is read again on resume, and its tasks that are
+        already annotated are filtered out, as the recipe may have split
+        it into several tasks.
+
+        offset (int): The offset of the line to resume from.
+        """
+        if offset is None or offset == self.offset:
+            return
+        state = {'offset': offset, 'hash': self.hash_line(offset)}
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            ujson.dump(state, f)
+        os.rename(tmp_path, self.state_path)
+        self.offset = offset
+
+    def close(self):
+        """Stop the feeder. The recipe reads the pipe through a descriptor
+        of its own, so closing ours doesn't stop it writing.
+        """
+        self.stopped.set()
+        self.thread.join()
+        os.close(self.fd)
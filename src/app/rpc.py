@@ -0,0 +1,239 @@
+# coding: utf8
+"""Direct calls from the web app to the worker that runs a job, over
+persistent TCP connections. Celery is still used to start jobs, but the
+job calls in the annotation loop skip the broker and the result backend.
+
+Each message is a frame: a 4-byte big-endian length followed by that many
+bytes of JSON. Requests are {"job": ..., "method": ..., "args": [...]},
+responses are {"result": ...} or {"error": ...}.
+"""
+from __future__ import unicode_literals
+
+import os
+import select
+import socket
+import struct
+import threading
+import ujson
+from celery.utils.log import get_logger
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+logger = get_logger(__name__)
+HEADER = struct.Struct('>I')
+JOB_METHODS = ('get_project', 'get_questions', 'give_answers', 'answer_and_fetch', 'get_stats')
+# methods without side effects, which can be sent again if no reply came
+IDEMPOTENT_METHODS = ('get_project', 'get_stats')
+
+
+class RPCError(Exception):
+    """Raised when the worker fails to run a call."""
+
+
+class RPCConnectionError(RPCError):
+    """Raised when the worker can't be reached. The call wasn't sent, so it
+    can be retried through Celery."""
+
+
+def is_alive(sock):
+    """
+    sock (socket.socket): An idle connection to a worker.
+    RETURNS (bool): Whether the connection is still open. Workers only send
+        replies, so an idle connection that's readable was closed.
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (socket.error, ValueError):
+        return False
+    return not readable
+
+
+def send_frame(sock, data):
+    payload = ujson.dumps(data, escape_forward_slashes=False).encode('utf8')
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def recv_frame(sock):
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    payload = recv_exactly(sock, HEADER.unpack(header)[0])
+    if payload is None:
+        raise socket.error('connection closed in the middle of a frame')
+    return ujson.loads(payload)
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            if chunks:
+                raise socket.error('connection closed in the middle of a frame')
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class RPCHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            try:
+                message = recv_frame(self.request)
+            except (socket.error, ValueError):
+                return
+            if message is None:
+                return
+            try:
+                if message['method'] not in JOB_METHODS:
+                    raise ValueError('invalid method "{}"'.format(message['method']))
+                job = self.server.factory.get_job(message['job'])
+                result = getattr(job, message['method'])(*message.get('args', []))
+                reply = {'result': result}
+            except Exception as e:
+                logger.exception('RPC CALL {!r} FAILED'.format(message))
+                reply = {'error': '{}: {}'.format(type(e).__name__, e)}
+            send_frame(self.request, reply)
+
+
+class RPCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, factory):
+        """
+        address (tuple): The (host, port) to listen on.
+        factory (app.tasks.ProdigyFactory): Looks up the jobs to call.
+        """
+        socketserver.TCPServer.__init__(self, address, RPCHandler)
+        self.factory = factory
+
+
+_SERVER = None
+_SERVER_PID = None
+
+
+def start_server(factory, host, port, advertise_host=None):
+    """Start the RPC server of this worker process in a background thread,
+    if it's not running yet. If the port is taken, e.g. by another worker
+    on the same machine, a free port is used instead.
+
+    factory (app.tasks.ProdigyFactory): Looks up the jobs to call.
+    host (unicode): The interface to listen on.
+    port (int): The port to listen on.
+    advertise_host (unicode): The host the web app should connect to.
+    RETURNS (unicode): The address of the server, as 'host:port'.
+    """
+    global _SERVER, _SERVER_PID
+    if _SERVER is None or _SERVER_PID != os.getpid():
+        try:
+            server = RPCServer((host, port), factory)
+        except socket.error:
+            server = RPCServer((host, 0), factory)
+        thread = threading.Thread(target=server.serve_forever, name='rpc-server')
+        thread.daemon = True
+        thread.start()
+        _SERVER, _SERVER_PID = server, os.getpid()
+        logger.warning('RPC SERVER LISTENING ON PORT {}'.format(server.server_address[1]))
+    advertise_host = advertise_host or socket.gethostbyname(socket.gethostname())
+    return '{}:{}'.format(advertise_host, _SERVER.server_address[1])
+
+
+class RPCClient(object):
+    def __init__(self, timeout=60.0):
+        """Call jobs on workers, keeping the connections open between calls.
+        Safe to use from multiple threads, each call uses its own connection.
+
+        timeout (float): Seconds to wait for a reply.
+        """
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def call(self, address, job_id, method, *args):
+        """
+        address (unicode): The worker's RPC address, as 'host:port'.
+        job_id (unicode): The job to call.
+        method (unicode): The job method, e.g. 'get_questions'.
+        *args: Arguments of the job method.
+        RETURNS: The result of the job method.
+        """
+        message = {'job': job_id, 'method': method, 'args': list(args)}
+        retries = 1
+        while True:
+            sock = self.checkout(address)
+            try:
+                reply = self.send(sock, message)
+                break
+            except RPCConnectionError as e:
+                # the request wasn't sent, e.g. because a restarted worker
+                # closed the connection, so it's sent again on a new one
+                sock.close()
+                self.close(address)
+                if not retries:
+                    raise RPCConnectionError('{}: {}'.format(address, e))
+            except (socket.error, socket.timeout) as e:
+                # the worker may have run the call, e.g. saved the answers,
+                # so only calls without side effects are sent again
+                sock.close()
+                if not retries or method not in IDEMPOTENT_METHODS:
+                    raise RPCError('{}: {}'.format(address, e))
+            retries -= 1
+        self.checkin(address, sock)
+        if 'error' in reply:
+            raise RPCError(reply['error'])
+        return reply['result']
+
+    def send(self, sock, message):
+        """Send a request and wait for the reply. Raises RPCConnectionError
+        if the request couldn't be sent, and socket.error if it was sent
+        but no reply came.
+        """
+        try:
+            send_frame(sock, message)
+        except socket.error as e:
+            # the worker ignores incomplete frames
+            raise RPCConnectionError(e)
+        reply = recv_frame(sock)
+        if reply is None:
+            raise socket.error('connection closed by worker')
+        return reply
+
+    def checkout(self, address):
+        while True:
+            with self.lock:
+                idle = self.idle.get(address)
+                sock = idle.pop() if idle else None
+            if sock is None:
+                return self.connect(address)
+            if is_alive(sock):
+                return sock
+            sock.close()
+
+    def connect(self, address):
+        host, port = address.rsplit(':', 1)
+        try:
+            sock = socket.create_connection((host, int(port)), timeout=self.timeout)
+        except socket.error as e:
+            raise RPCConnectionError('{}: {}'.format(address, e))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def checkin(self, address, sock):
+        with self.lock:
+            self.idle.setdefault(address, []).append(sock)
+
+    def close(self, address):
+        """Close the idle connections to a worker, e.g. after it went away."""
+        with self.lock:
+            sockets = self.idle.pop(address, [])
+        for sock in sockets:
+            sock.close()
@@ -10,6 +10,31 @@ BASE_URL = environ.get('BASE_URL', 'http://127.0.0.1')
 DATA_DIR = environ.get('DATA_DIR', '../data')
 CELERY_BROKER = environ.get('CELERY_BROKER', 'redis://192.168.99.100:6379/0')
 CELERY_BACKEND = environ.get('CELERY_BACKEND', 'redis://192.168.99.100:6379/0')
+REGISTRY_URL = environ.get('REGISTRY_URL', CELERY_BROKER)
+HEARTBEAT_INTERVAL = int(environ.get('HEARTBEAT_INTERVAL', 10))
+ANSWER_BUFFER = environ.get('ANSWER_BUFFER') == '1'
+ANSWER_BUFFER_SIZE = 50
+ANSWER_BUFFER_INTERVAL = 5.0
+JOURNAL_DIR = environ.get('JOURNAL_DIR', '{}/journal'.format(DATA_DIR))
+EXPORT_CHUNK_SIZE = 1000
+SNAPSHOT_DIR = environ.get('SNAPSHOT_DIR', '{}/snapshots'.format(DATA_DIR))
+FORK_JOBS = environ.get('FORK_JOBS') == '1'
+JOB_IDLE_TTL = int(environ.get('JOB_IDLE_TTL', 0))
+JOB_MAX_ACTIVE = int(environ.get('JOB_MAX_ACTIVE', 0))
+HIBERNATE_DIR = environ.get('HIBERNATE_DIR', '{}/hibernated'.format(DATA_DIR))
+SOURCE_RESUME = environ.get('SOURCE_RESUME') == '1'
+RESUME_DIR = environ.get('RESUME_DIR', '{}/resume'.format(DATA_DIR))
+MODEL_FOOTPRINT = int(environ.get('MODEL_FOOTPRINT', 500))
+WORKER_MAX_JOBS = int(environ.get('WORKER_MAX_JOBS', 0))
+WORKER_MEMORY = int(environ.get('WORKER_MEMORY', 0))
+MODEL_MEMORY_BUDGET = int(environ.get('MODEL_MEMORY_BUDGET', 0))
+QUESTION_PREFETCH = int(environ.get('QUESTION_PREFETCH', 0))
+RPC_ENABLED = environ.get('RPC_ENABLED', '1') == '1'
+RPC_HOST = environ.get('RPC_HOST')
+RPC_PORT = int(environ.get('LISTEN_PORT', 6000))
+GATEWAY_FLASK_PORT = int(environ.get('GATEWAY_FLASK_PORT', 8081))
+JSON_GZIP_MIN_SIZE = int(environ.get('JSON_GZIP_MIN_SIZE', 1024))
+ASSET_CACHE_DIR = environ.get('ASSET_CACHE_DIR', '{}/assets'.format(DATA_DIR))
 
 PRODIGY_CONFIG = {
     "db": "postgresql",
@@ -19,11 +44,18 @@ PRODIGY_CONFIG = {
             "port": 5432,
             "dbname": "prodigy",
             "user": environ.get('DB_USER'),
-            "password": environ.get('DB_PASS')
+            "password": environ.get('DB_PASS'),
+            "max_connections": int(environ.get('DB_POOL_SIZE', 8)),
+            "stale_timeout": int(environ.get('DB_POOL_MAX_AGE', 300)),
+            "pool_timeout": int(environ.get('DB_POOL_TIMEOUT', 10)),
+            "dedupe": environ.get('DB_DEDUPE') == '1',
+            "compress": environ.get('DB_COMPRESS') == '1'
         },
         "sqlite": {
             "name": "prodigy.db",
-            "path": DATA_DIR
+            "path": DATA_DIR,
+            "dedupe": environ.get('DB_DEDUPE') == '1',
+            "compress": environ.get('DB_COMPRESS') == '1'
         }
     },
     "theme": "basic",
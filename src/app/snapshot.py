@@ -0,0 +1,176 @@
+# coding: utf8
+"""Columnar snapshots of datasets, for training and analysis jobs that read
+the same consolidated data many times. A snapshot is a directory of NumPy
+arrays and a text buffer that are opened memory-mapped, so loading one
+parses nothing and repeated reads are served from the page cache.
+
+Write a snapshot from the src directory with:
+
+    python -m app.snapshot <dataset> [output_dir]
+"""
+from __future__ import unicode_literals, print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import ujson
+import numpy
+from array import array
+
+from app.settings import *
+
+
+ANSWERS = ('accept', 'reject', 'ignore')
+
+
+class DatasetSnapshot(object):
+    def __init__(self, path):
+        """Open a snapshot written by write_snapshot. The arrays are
+        memory-mapped read-only and nothing is decoded up front.
+
+        path (unicode): The snapshot directory.
+        """
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = ujson.load(f)
+        self.labels = self.meta['labels']
+        self.input_hash = self._load('input_hash')
+        self.task_hash = self._load('task_hash')
+        self.answer = self._load('answer')
+        self.label = self._load('label')
+        self.text_offsets = self._load('text_offsets')
+        self.span_offsets = self._load('span_offsets')
+        self.span_start = self._load('span_start')
+        self.span_end = self._load('span_end')
+        self.span_label = self._load('span_label')
+        if self.text_offsets[-1]:
+            self.text_buffer = numpy.memmap(os.path.join(path, 'text.bin'),
+                                            dtype=numpy.uint8, mode='r')
+        else:
+            self.text_buffer = numpy.zeros((0,), dtype=numpy.uint8)
+
+    def _load(self, name):
+        return numpy.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def __len__(self):
+        """
+        RETURNS (int): The number of examples in the snapshot.
+        """
+        return len(self.input_hash)
+
+    def __iter__(self):
+        """
+        YIELDS (dict): The examples, with their text, label, answer and spans.
+        """
+        for i in range(len(self)):
+            yield self.get_example(i)
+
+    def get_text(self, i):
+        """
+        i (int): The example index.
+        RETURNS (unicode): The text of the example.
+        """
+        start, end = self.text_offsets[i], self.text_offsets[i + 1]
+        return self.text_buffer[start:end].tobytes().decode('utf8')
+
+    def get_spans(self, i):
+        """
+        i (int): The example index.
+        RETURNS (list): (start, end, label) tuples of the example's spans.
+        """
+        start, end = self.span_offsets[i], self.span_offsets[i + 1]
+        return [(int(s), int(e), self.labels[l]) for s, e, l in
+                zip(self.span_start[start:end], self.span_end[start:end],
+                    self.span_label[start:end])]
+
+    def get_example(self, i):
+        """
+        i (int): The example index.
+        RETURNS (dict): The example, in the same format as the dataset.
+        """
+        eg = {'_input_hash': int(self.input_hash[i]), '_task_hash': int(self.task_hash[i]),
+              'text': self.get_text(i),
+              'spans': [{'start': s, 'end': e, 'label': l} for s, e, l in self.get_spans(i)]}
+        if self.answer[i] >= 0:
+            eg['answer'] = ANSWERS[self.answer[i]]
+        if self.label[i] >= 0:
+            eg['label'] = self.labels[self.label[i]]
+        return eg
+
+
+def write_snapshot(db, name, path):
+    """Write a dataset to a snapshot directory, streaming the examples from
+    the database. The snapshot is written next to the destination and then
+    moved in place, so readers never see a partial snapshot.
+
+    db (app.database.Database): The database.
+    name (unicode): The dataset name.
+    path (unicode): The snapshot directory. Replaced if it exists.
+    RETURNS (int): The number of examples in the snapshot.
+    """
+    if name not in db:
+        raise ValueError("Can't find dataset '{}'.".format(name))
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    labels = {}
+    columns = dict((key, array('q')) for key in ('input_hash', 'task_hash', 'answer', 'label',
+                                                 'span_start', 'span_end', 'span_label'))
+    text_offsets = array('q', [0])
+    span_offsets = array('q', [0])
+    with open(os.path.join(tmp_path, 'text.bin'), 'wb') as text_file:
+        for eg in db.iter_dataset(name):
+            text = eg.get('text', '').encode('utf8')
+            text_file.write(text)
+            text_offsets.append(text_offsets[-1] + len(text))
+            columns['input_hash'].append(eg['_input_hash'])
+            columns['task_hash'].append(eg['_task_hash'])
+            answer = eg.get('answer')
+            columns['answer'].append(ANSWERS.index(answer) if answer in ANSWERS else -1)
+            label = eg.get('label')
+            columns['label'].append(labels.setdefault(label, len(labels)) if label else -1)
+            spans = eg.get('spans', [])
+            for span in spans:
+                columns['span_start'].append(span['start'])
+                columns['span_end'].append(span['end'])
+                columns['span_label'].append(labels.setdefault(span['label'], len(labels)))
+            span_offsets.append(span_offsets[-1] + len(spans))
+    dtypes = {'input_hash': numpy.int64, 'task_hash': numpy.int64, 'answer': numpy.int8,
+              'label': numpy.int32, 'span_start': numpy.int32, 'span_end': numpy.int32,
+              'span_label': numpy.int32}
+    for key, values in columns.items():
+        numpy.save(os.path.join(tmp_path, key + '.npy'), numpy.array(values, dtype=dtypes[key]))
+    numpy.save(os.path.join(tmp_path, 'text_offsets.npy'), numpy.array(text_offsets, dtype=numpy.int64))
+    numpy.save(os.path.join(tmp_path, 'span_offsets.npy'), numpy.array(span_offsets, dtype=numpy.int64))
+    meta = {'dataset': name, 'size': len(text_offsets) - 1,
+            'labels': sorted(labels, key=labels.get)}
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        ujson.dump(meta, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return meta['size']
+
+
+def get_snapshot_path(name):
+    """
+    name (unicode): The dataset name.
+    RETURNS (unicode): The default snapshot directory of the dataset.
+    """
+    return '{}/{}'.format(SNAPSHOT_DIR, name)
+
+
+if __name__ == '__main__':
+    from app.database import connect
+
+    if len(sys.argv) < 2:
+        print('usage: python -m app.snapshot <dataset> [output_dir]')
+        sys.exit(1)
+    dataset = sys.argv[1]
+    output = sys.argv[2] if len(sys.argv) > 2 else get_snapshot_path(dataset)
+    dbname = PRODIGY_CONFIG['db']
+    n_examples = write_snapshot(connect(dbname, PRODIGY_CONFIG['db_settings'][dbname]),
+                                dataset, output)
+    print('Wrote {} examples of {} to {}'.format(n_examples, dataset, output))
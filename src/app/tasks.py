@@ -2,41 +2,131 @@
 from __future__ import unicode_literals
 
 import os
+import time
 import uuid
+import ujson
 import re
 import shutil
 import os.path
+import threading
+from collections import OrderedDict
 from celery import Celery
+from celery.signals import worker_process_init, celeryd_init, worker_ready
 from celery.utils.log import get_logger
+from prodigy.util import TASK_HASH_ATTR
 from app.settings import *
+from app.journal import AnswerJournal, JournaledDatabase
+from app.prefetch import QuestionPrefetcher
+from app.resume import ResumableSource
+from app.models import ModelRegistry, UPDATING_RECIPES, get_free_memory
+from app.rpc import start_server
+from app.registry import JobRegistry
+from app.forkserver import JobProcess, preload, start_forkserver
+from app.catalog import get_instructions
 
 
 logger = get_logger(__name__)
 celery = Celery('tasks', broker=CELERY_BROKER, backend=CELERY_BACKEND)
-
-
-def make_prodigy(job_id, project_id, settings, logger, debug=False):
+# spaCy models loaded in this worker process, shared by its jobs
+MODELS = ModelRegistry(MODEL_MEMORY_BUDGET)
+REGISTRY = JobRegistry(REGISTRY_URL, HEARTBEAT_INTERVAL * 3)
+# the node name of this worker, e.g. 'celery@host'
+WORKER_NAME = None
+
+
+@worker_process_init.connect
+def preload_models(**kwargs):
+    if FORK_JOBS:
+        preload(PROJECTS, MODELS, DATA_DIR)
+        # before the worker process starts any thread
+        start_forkserver(make_forked_job)
+
+
+@celeryd_init.connect
+def set_worker_name(sender=None, **kwargs):
+    global WORKER_NAME
+    WORKER_NAME = sender
+
+
+@celeryd_init.connect
+def size_db_pool(conf=None, options=None, **kwargs):
+    """Make the database pool large enough for every task a worker process
+    runs at once. A gevent, eventlet or thread pool runs up to --concurrency
+    tasks in one process, a prefork pool one per process. Other threads of
+    the jobs, e.g. the prefetchers, wait up to DB_POOL_TIMEOUT seconds for
+    a connection while all are in use.
+    """
+    options = options or {}
+    pool = options.get('pool_cls') or conf.worker_pool
+    name = pool if isinstance(pool, str) else getattr(pool, '__module__', '')
+    if not any(green in name for green in ('gevent', 'eventlet', 'thread')):
+        return
+    concurrency = int(options.get('concurrency') or conf.worker_concurrency or os.cpu_count())
+    db_settings = PRODIGY_CONFIG['db_settings'].get(PRODIGY_CONFIG['db'], {})
+    size = db_settings.get('max_connections')
+    if size and size < concurrency:
+        logger.warning('DB POOL SIZE RAISED FROM {} TO {}, THE CONCURRENCY OF THE WORKER'
+                       .format(size, concurrency))
+        db_settings['max_connections'] = concurrency
+
+
+@worker_ready.connect
+def start_heartbeat(**kwargs):
+    """Report that the worker is alive and the memory it has left, so the
+    web app can place new jobs where they fit.
+    """
+    def beat():
+        while True:
+            try:
+                REGISTRY.beat_worker(WORKER_NAME, get_free_memory(WORKER_MEMORY * 1024 * 1024))
+            except Exception:
+                logger.exception('WORKER HEARTBEAT FAILED')
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    thread = threading.Thread(target=beat, name='worker-heartbeat')
+    thread.daemon = True
+    thread.start()
+
+
+def make_prodigy(job_id, project_id, settings, logger, debug=False, state=None):
     import prodigy
-    from app.database import connect
+    from app.database import connect, use_for_prodigy
 
     if debug:
         os.environ["PRODIGY_LOGGING"] = 'basic'
 
     dbname = PRODIGY_CONFIG['db']
-    connect(dbname, PRODIGY_CONFIG['db_settings'][dbname])
+    db = connect(dbname, PRODIGY_CONFIG['db_settings'][dbname])
+    # recipes that connect to the database themselves get the same one
+    use_for_prodigy(db)
 
     loaded_recipe = prodigy.get_recipe(settings['recipe'])
     if not loaded_recipe:
         raise ValueError("Can't find recipe {}.".format(settings['recipe']))
 
+    # a hibernated job continues with the weights its model had
+    saved_models = state['models'] if state else {}
     args = []   # to maintaint order of arguments
     for item in settings['recipe_sig']:
         if item in settings['recipe_args']:
-            args.append(settings['recipe_args'][item])
+            value = settings['recipe_args'][item]
+            args.append(saved_models.get(value, value) if item == 'spacy_model' else value)
         else:
             args.append(None)
 
-    controller = loaded_recipe(*args)
+    # recipes that don't update their model share it with the other jobs
+    shared = settings.get('shared_model', settings['recipe'] not in UPDATING_RECIPES)
+    with MODELS.capture(shared) as models:
+        controller = loaded_recipe(*args)
+    if state and state.get('session_id'):
+        # keep adding the answers to the session of the hibernated job
+        try:
+            controller.session_id = state['session_id']
+        except AttributeError:
+            logger.warning('JOB "{}" STARTED A NEW SESSION'.format(job_id))
+    # save answers through the app's database, which shares pooled
+    # connections between the requests of all jobs in this worker
+    controller.db = db
     controller.config.update(PRODIGY_CONFIG)
     if 'config' in settings:
         controller.config.update(settings['config'])
@@ -47,28 +137,51 @@ def make_prodigy(job_id, project_id, settings, logger, debug=False):
     config['version'] = prodigy.about.__version__
 
     if 'instructions' in settings:
-        help_path = Path('{}/{}'.format(DATA_DIR, settings['instructions']))
-        if help_path.is_file():
-            with help_path.open('r', encoding='utf8') as f:
-                config['instructions'] = f.read()
-        else:
-            config['instructions'] = settings['instructions']
+        config['instructions'], _ = get_instructions(settings['instructions'], DATA_DIR)
 
     for setting in ['db_settings', 'api_keys']:
         if setting in config:
             config.pop(setting)
 
     controller.save()
-    return config, controller
+    return config, controller, models
 
 
 class ProdigyJob(object):
-    def __init__(self, job_id, project_id, settings, logger, debug=False):
+    def __init__(self, job_id, project_id, settings, logger, debug=False, state=None):
         self.id = job_id
         self.uid = str(uuid.uuid4())[:8]
         self.logger = logger
         self.debug = debug
-        self.config, self.controller = make_prodigy(self.id, project_id, settings, self.logger, self.debug)
+        self.dataset = settings['recipe_args'].get('dataset')
+        self.updates_model = settings['recipe'] in UPDATING_RECIPES
+        # the controller isn't thread-safe, and the prefetcher fetches
+        # questions from its own thread
+        self.lock = threading.RLock()
+        self.source = None
+        source = settings['recipe_args'].get('source')
+        if settings.get('resume', SOURCE_RESUME) and source and source.endswith('.jsonl'):
+            # the recipe reads the source from where the last answer was
+            self.source = ResumableSource(source, '{}/{}.json'.format(RESUME_DIR, self.id))
+            recipe_args = dict(settings['recipe_args'], source=self.source.source)
+            recipe_args['--loader'] = 'jsonl'
+            settings = dict(settings, recipe_args=recipe_args)
+        self.config, self.controller, self.models = make_prodigy(self.id, project_id, settings,
+                                                                 self.logger, self.debug, state)
+        self.db = self.controller.db
+        self.journal = None
+        if settings.get('write_behind', ANSWER_BUFFER):
+            path = '{}/{}.jsonl'.format(JOURNAL_DIR, self.id)
+            self.journal = AnswerJournal(path, self.write_answers, ANSWER_BUFFER_SIZE,
+                                         ANSWER_BUFFER_INTERVAL)
+            self.journal.flush()
+            # the controller receives the answers right away, only saving
+            # them to the database is deferred
+            self.controller.db = JournaledDatabase(self.db, self.journal)
+        self.prefetch = None
+        depth = settings.get('prefetch', QUESTION_PREFETCH)
+        if depth:
+            self.prefetch = QuestionPrefetcher(self.fetch_questions, depth)
 
     def get_project(self):
         self.logger.debug('CALLED "get_project" on job {} '.format(self.id))
@@ -76,45 +189,159 @@ class ProdigyJob(object):
 
     def get_questions(self):
         self.logger.debug('CALLED "get_questions" on job {} '.format(self.id))
-        if self.controller.db and hasattr(self.controller.db, 'reconnect'):
-            self.controller.db.reconnect()
-        questions = self.controller.get_questions()
-        result = {'tasks': questions, 'total': self.controller.total_annotated,
-                  'progress': self.controller.progress}
-        if self.controller.db and hasattr(self.controller.db, 'close'):
-            self.controller.db.close()
-        return result
+        if self.prefetch is not None:
+            # wait without holding the lock, the prefetcher needs it to fetch
+            questions = self.prefetch.get()
+        else:
+            questions = self.fetch_questions()
+        with self.lock:
+            return {'tasks': questions, 'total': self.controller.total_annotated,
+                    'progress': self.controller.progress}
+
+    def fetch_questions(self):
+        with self.lock:
+            if self.controller.db and hasattr(self.controller.db, 'reconnect'):
+                self.controller.db.reconnect()
+            questions = self.controller.get_questions()
+            if self.controller.db and hasattr(self.controller.db, 'close'):
+                self.controller.db.close()
+            if self.source is not None:
+                self.source.sent(questions)
+        return questions
 
     def give_answers(self, answers):
         self.logger.debug('CALLED "give_answers" on job {} with: '.format(self.id, repr(answers)))
         answers = answers['answers']
-        if self.controller.db and hasattr(self.controller.db, 'reconnect'):
-            self.controller.db.reconnect()
-        self.controller.receive_answers(answers)
-        result = {'progress': self.controller.progress}
-        if self.controller.db and hasattr(self.controller.db, 'close'):
-            self.controller.db.close()
-        return result
+        # with write-behind answers, this returns once they're in the
+        # journal, which saves them to the database in the background
+        self.save_answers(answers)
+        return {'progress': self.controller.progress}
+
+    def answer_and_fetch(self, answers):
+        """Receive answers and get the next batch in one call, so the web
+        app doesn't need a second round-trip. No other call of the job runs
+        in between, so without prefetching, the batch is scored by the model
+        the answers updated. Prefetched batches may be older, see
+        QuestionPrefetcher.
+        """
+        self.logger.debug('CALLED "answer_and_fetch" on job {} '.format(self.id))
+        if self.prefetch is not None:
+            # the prefetcher needs the lock to fetch the batch
+            self.give_answers(answers)
+            return self.get_questions()
+        with self.lock:
+            self.give_answers(answers)
+            return self.get_questions()
+
+    def save_answers(self, answers):
+        with self.lock:
+            offset = self.source.get_offset(answers) if self.source is not None else None
+            if self.controller.db and hasattr(self.controller.db, 'reconnect'):
+                self.controller.db.reconnect()
+            self.controller.receive_answers(answers)
+            if self.controller.db and hasattr(self.controller.db, 'close'):
+                self.controller.db.close()
+            if self.source is not None:
+                self.source.save(offset)
+
+    def write_answers(self, answers, datasets):
+        """Save answers from the journal to the database. Answers already
+        in the last dataset, the session dataset, are skipped: the journal
+        of a run that stopped after saving a batch but before removing it
+        is saved again when the job starts.
+
+        answers (list): The annotated tasks.
+        datasets (list): The names of the datasets to add them to.
+        """
+        if hasattr(self.db, 'reconnect'):
+            self.db.reconnect()
+        if datasets:
+            saved = self.db.get_linked_task_hashes(datasets[-1], [eg[TASK_HASH_ATTR] for eg in answers])
+            answers = [eg for eg in answers if eg[TASK_HASH_ATTR] not in saved]
+        if answers:
+            self.db.add_examples(answers, datasets=datasets)
+        if hasattr(self.db, 'close'):
+            self.db.close()
 
     def get_stats(self):
         self.logger.debug('CALLED "get_stats" on job {} '.format(self.id))
-        if self.controller.db and hasattr(self.controller.db, 'reconnect'):
-            self.controller.db.reconnect()
+        with self.lock:
+            if self.controller.db and hasattr(self.controller.db, 'reconnect'):
+                self.controller.db.reconnect()
+
+            result = {'total': self.controller.total_annotated,
+                      'progress': self.controller.progress,
+                      'accept': 0, 'reject': 0, 'ignore': 0, 'meta': 0}
+
+            if self.dataset and hasattr(self.controller.db, 'get_answer_counts'):
+                result.update(self.controller.db.get_answer_counts(self.dataset))
 
-        result = {'total': self.controller.total_annotated,
-                  'progress': self.controller.progress,
-                  'accept': 0, 'reject': 0, 'ignore': 0, 'meta': 0}
+            if hasattr(self.config, 'meta'):
+                result['meta'] = self.config['meta']
 
-        if hasattr(self.config, 'meta'):
-            result['meta'] = self.config['meta']
+            if self.prefetch is not None:
+                result['prefetch'] = self.prefetch.stats
 
-        if self.controller.db and hasattr(self.controller.db, 'close'):
-            self.controller.db.close()
+            if self.controller.db and hasattr(self.controller.db, 'close'):
+                self.controller.db.close()
         return result
 
+    def hibernate(self, path):
+        """Save the state of the job and stop it, so it can be restored by
+        make_prodigy later: the session id and the weights of the models the
+        job updates. The stream is rebuilt on restore, and skips the tasks
+        already saved to the dataset, so the answers are saved first.
+
+        path (unicode): Directory to save the state to.
+        """
+        with self.lock:
+            if self.journal is not None:
+                self.journal.flush()
+            if not os.path.exists(path):
+                os.makedirs(path)
+            state = {'session_id': getattr(self.controller, 'session_id', None),
+                     'models': {}, 'hibernated': time.time()}
+            # a forked job updates its copy of the preloaded model, which it
+            # loaded as shared
+            models = self.models['loaded'] if self.updates_model else self.models['private']
+            for i, (name, nlp) in enumerate(models.items()):
+                model_path = '{}/model_{}'.format(path, i)
+                nlp.to_disk(model_path)
+                state['models'][name] = model_path
+            with open('{}/state.json'.format(path), 'w') as f:
+                ujson.dump(state, f, escape_forward_slashes=False)
+            self.close()
+        self.logger.warning('JOB "{}" HIBERNATED TO {}'.format(self.id, path))
+
+    def close(self):
+        """Stop the background threads of the job and release its shared
+        models, so they can be evicted once no other job uses them.
+        """
+        if self.journal is not None:
+            self.journal.close()
+        if self.prefetch is not None:
+            self.prefetch.close()
+        if self.source is not None:
+            self.source.close()
+        for name in self.models['shared']:
+            MODELS.release(name)
+        self.models = {'shared': [], 'private': {}, 'loaded': {}}
+
 
 class ProdigyFactory(object):
-    _jobs = {}
+    # running jobs, least recently used first
+    _jobs = OrderedDict()
+    _used = {}
+    # (project_id, user_id) of every job started in this process
+    _started = {}
+    _hibernated = set()
+    # guards the dicts above, and is never held while a job starts, runs or
+    # hibernates, so jobs don't wait for each other
+    _lock = threading.RLock()
+    # per job, held while the job starts, is restored or hibernates
+    _job_locks = {}
+    _reaper = None
+    _heartbeat = None
 
     def __init__(self):
         self.id = str(uuid.uuid4())[:8]
@@ -123,28 +350,66 @@ class ProdigyFactory(object):
     def get_job(self, job_id):
         logger.debug('_factory -> {}'.format(self.id))
 
+        with self.job_lock(job_id):
+            if job_id in self._hibernated:
+                self.start_job(job_id, *self._started[job_id])
+            with self._lock:
+                job = self.use_job(job_id)
+        self.evict(keep=job_id)
+        return job
+
+    def job_lock(self, job_id):
+        with self._lock:
+            return self._job_locks.setdefault(job_id, threading.RLock())
+
+    def use_job(self, job_id):
         if job_id not in self._jobs:
             logger.debug('_jobs -> len: {}, repr: {}'.format(len(self._jobs), repr(self._jobs)))
             raise KeyError('invalid job_id "{}"'.format(job_id))
 
-        return self._jobs[job_id]
+        job = self._jobs[job_id]
+        if not getattr(job, 'alive', True):
+            # the job process crashed, the job has to be started again
+            del self._jobs[job_id]
+            job.close()
+            raise KeyError('job "{}" is gone'.format(job_id))
+        self._jobs.move_to_end(job_id)
+        self._used[job_id] = time.time()
+        return job
 
     def create_job(self, job_id, project_id, user_id):
         logger.debug('_factory -> {}'.format(self.id))
 
+        with self.job_lock(job_id):
+            job = self.start_job(job_id, project_id, user_id)
+            with self._lock:
+                self.use_job(job_id)
+        self.evict(keep=job_id)
+        self.start_reaper()
+        self.start_heartbeat()
+        return job
+
+    def start_job(self, job_id, project_id, user_id):
+        """Start a job, or restore it if it was hibernated. Must be called
+        with the lock of the job held.
+        """
         if job_id not in self._jobs:
             logger.warning('JOB "{}" IS STARTING'.format(job_id))
 
-            if project_id not in ['manual_general']:
-                # model shoud be copied per user
+            # copied, so the user's values don't end up in the project
+            settings = dict(PROJECTS[project_id])
+            settings['recipe_args'] = dict(settings['recipe_args'])
+
+            if settings['recipe'] in UPDATING_RECIPES:
+                # the recipe updates the model, so it's copied per user,
+                # other recipes share the loaded model of the worker
                 orig = '{}/{}/model_v1'.format(DATA_DIR, project_id)
                 dest = '{}/{}/jobs/{}/model_v1/'.format(DATA_DIR, project_id, job_id)
                 if not os.path.exists(dest):
                     shutil.copytree(orig, dest)
 
-            settings = PROJECTS[project_id]
-
-            rep = {"{project_id}": project_id, "{user_id}": user_id, "{job_id}": job_id, "{base_path}": DATA_DIR}
+            rep = {"{project_id}": project_id, "{user_id}": user_id, "{job_id}": job_id, "{base_path}": DATA_DIR,
+                   "{data_dir}": DATA_DIR}
             rep = dict((re.escape(k), v) for k, v in rep.items())
             pattern = re.compile("|".join(rep.keys()))
 
@@ -156,8 +421,21 @@ class ProdigyFactory(object):
 
             logger.info('JOB "{}" SETTINGS: {}'.format(job_id, repr(settings)))
 
-            self._jobs[job_id] = ProdigyJob(job_id, project_id, settings, logger, False)
-            job = self._jobs[job_id]
+            state = load_state(job_id)
+            if FORK_JOBS:
+                # the child shares the preloaded models copy-on-write, so
+                # even recipes that update their model can use them
+                settings = dict(settings, shared_model=True)
+                job = JobProcess(job_id, [project_id, settings, state])
+            else:
+                job = ProdigyJob(job_id, project_id, settings, logger, False, state)
+            with self._lock:
+                self._jobs[job_id] = job
+                self._started[job_id] = (project_id, user_id)
+                self._hibernated.discard(job_id)
+            if state:
+                os.remove('{}/{}/state.json'.format(HIBERNATE_DIR, job_id))
+                logger.warning('JOB "{}" RESTORED'.format(job_id))
             logger.warning('JOB "{}" (uid: {}) IS READY'.format(job_id, job.uid))
         else:
             job = self._jobs[job_id]
@@ -166,6 +444,129 @@ class ProdigyFactory(object):
         logger.debug('_jobs -> len: {}, repr: {}'.format(len(self._jobs), repr(self._jobs)))
         return job
 
+    def evict(self, keep=None):
+        """Hibernate the jobs that were idle for longer than JOB_IDLE_TTL,
+        and the least recently used jobs while more than JOB_MAX_ACTIVE are
+        running. They're restored by get_job when they're used again.
+
+        keep (unicode): A job that's about to be used and stays running.
+        """
+        now = time.time()
+        evicted = []
+        with self._lock:
+            over = len(self._jobs) - JOB_MAX_ACTIVE if JOB_MAX_ACTIVE else 0
+            for job_id in self._jobs:
+                used = self._used.get(job_id, now)
+                idle = JOB_IDLE_TTL and now - used > JOB_IDLE_TTL
+                if job_id != keep and (idle or len(evicted) < over):
+                    evicted.append((job_id, used))
+        for job_id, used in evicted:
+            self.hibernate(job_id, used)
+
+    def hibernate(self, job_id, used=None):
+        """
+        job_id (unicode): The job to hibernate.
+        used (float): When the job was last used. If it was used since, it
+            keeps running.
+        """
+        with self.job_lock(job_id):
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or (used is not None and self._used.get(job_id) != used):
+                    return
+            try:
+                job.hibernate('{}/{}'.format(HIBERNATE_DIR, job_id))
+            except Exception:
+                # the job keeps running, its state may not have been saved
+                logger.exception('JOB "{}" FAILED TO HIBERNATE'.format(job_id))
+                return
+            if isinstance(job, JobProcess):
+                job.close()
+            with self._lock:
+                del self._jobs[job_id]
+                self._used.pop(job_id, None)
+                self._hibernated.add(job_id)
+
+    def start_reaper(self):
+        """Start a thread that hibernates idle jobs, if it's not running in
+        this process yet.
+        """
+        if not JOB_IDLE_TTL:
+            return
+        with self._lock:
+            reaper = ProdigyFactory._reaper
+            if reaper is not None and reaper[0] == os.getpid():
+                return
+            thread = threading.Thread(target=self.reap, name='job-reaper')
+            thread.daemon = True
+            thread.start()
+            ProdigyFactory._reaper = (os.getpid(), thread)
+
+    def reap(self):
+        while True:
+            time.sleep(min(JOB_IDLE_TTL, 60))
+            try:
+                self.evict()
+            except Exception:
+                logger.exception('JOB REAPER FAILED')
+
+    def start_heartbeat(self):
+        """Report the jobs of this process to the job registry right away,
+        and start a thread that keeps reporting them, if it's not running in
+        this process yet.
+        """
+        self.beat()
+        with self._lock:
+            heartbeat = ProdigyFactory._heartbeat
+            if heartbeat is not None and heartbeat[0] == os.getpid():
+                return
+            thread = threading.Thread(target=self.keep_beating, name='job-heartbeat')
+            thread.daemon = True
+            thread.start()
+            ProdigyFactory._heartbeat = (os.getpid(), thread)
+
+    def beat(self):
+        if WORKER_NAME is None:
+            # not running in a worker
+            return
+        with self._lock:
+            job_ids = list(self._jobs) + list(self._hibernated)
+        try:
+            REGISTRY.beat_jobs(WORKER_NAME, job_ids, self.get_address())
+        except Exception:
+            logger.exception('JOB HEARTBEAT FAILED')
+
+    def keep_beating(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            self.beat()
+
+    def get_address(self):
+        """Start the RPC server of this worker process if needed, so the web
+        app can call its jobs directly instead of through the broker.
+        RETURNS (unicode): The RPC address, or None if RPC is disabled.
+        """
+        if not RPC_ENABLED:
+            return None
+        return start_server(self, '0.0.0.0', RPC_PORT, RPC_HOST)
+
+
+def make_forked_job(job_id, project_id, settings, state):
+    """Create a job in a process forked by the fork server."""
+    return ProdigyJob(job_id, project_id, settings, logger, False, state)
+
+
+def load_state(job_id):
+    """
+    job_id (unicode): The job id.
+    RETURNS (dict): The state saved when the job was hibernated, or None.
+    """
+    path = '{}/{}/state.json'.format(HIBERNATE_DIR, job_id)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return ujson.load(f)
+
 
 class ProdigyTask(celery.Task):
 
@@ -174,15 +575,9 @@ class ProdigyTask(celery.Task):
 
 
 class SpacyTask(celery.Task):
-    _models = {}
-
-    @property
-    def model(self, name):
-        if not name in self._models:
-            import spacy
-            self._models[name] = spacy.load(name)
 
-        return self._models[name]
+    def get_model(self, name):
+        return MODELS.get(name)
 
 
 @celery.task(bind=True, base=ProdigyTask)
@@ -190,7 +585,16 @@ def start_job(self, job_id, project_id, user_id):
     logger.debug('Executing task id {0.id}, args: {0.args!r} kwargs: {0.kwargs!r}'.format(self.request))
     job = self.jobs.create_job(job_id, project_id, user_id)
     job = self.jobs.get_job(job.id)
-    return self.request.hostname, job.id, job.uid
+    return self.request.hostname, job.id, job.uid, self.jobs.get_address()
+
+
+@celery.task(bind=True, base=ProdigyTask)
+def get_job_address(self, job_id):
+    logger.debug('Executing task id {0.id}, args: {0.args!r} kwargs: {0.kwargs!r}'.format(self.request))
+    # called to start the job, or restore it if it's hibernated, before
+    # its caller connects to the address
+    self.jobs.get_job(job_id)
+    return self.jobs.get_address()
 
 
 @celery.task(bind=True, base=ProdigyTask)
@@ -214,6 +618,13 @@ def give_answers(self, job_id, data):
     return job.give_answers(data)
 
 
+@celery.task(bind=True, base=ProdigyTask)
+def answer_and_fetch(self, job_id, data):
+    logger.debug('Executing task id {0.id}, args: {0.args!r} kwargs: {0.kwargs!r}'.format(self.request))
+    job = self.jobs.get_job(job_id)
+    return job.answer_and_fetch(data)
+
+
 @celery.task(bind=True, base=ProdigyTask)
 def get_stats(self, job_id):
     logger.debug('Executing task id {0.id}, args: {0.args!r} kwargs: {0.kwargs!r}'.format(self.request))
@@ -238,10 +649,26 @@ def train_models(self):
     # train model_general 
 
 
+@celery.task(bind=True)
+def snapshot_dataset(self, name, path=None):
+    """Write a columnar snapshot of a dataset, e.g. after consolidating it,
+    so training jobs can open it with app.snapshot.DatasetSnapshot.
+    """
+    from app.database import connect
+    from app.snapshot import write_snapshot, get_snapshot_path
+
+    dbname = PRODIGY_CONFIG['db']
+    db = connect(dbname, PRODIGY_CONFIG['db_settings'][dbname])
+    path = path or get_snapshot_path(name)
+    n_examples = write_snapshot(db, name, path)
+    logger.info('SNAPSHOT OF "{}" WITH {} EXAMPLES WRITTEN TO {}'.format(name, n_examples, path))
+    return path, n_examples
+
+
 @celery.task(bind=True, base=SpacyTask)
 def get_prediction(self, text, modelname, only_ents=True):
     logger.debug('Executing task id {0.id}, args: {0.args!r} kwargs: {0.kwargs!r}'.format(self.request))
-    nlp = self.model(modelname)
+    nlp = self.get_model(modelname)
     doc = nlp(text)
     if only_ents:
         return list(doc.ents)
@@ -0,0 +1,104 @@
+# coding: utf8
+from __future__ import unicode_literals
+
+import pytest
+
+from app import models
+from app.placement import WorkerLoad, get_worker_loads, place_job
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def projects():
+    return {'manual': {'recipe': 'ner.manual', 'recipe_args': {'spacy_model': 'en_core_web_sm'}},
+            'teach': {'recipe': 'ner.teach', 'recipe_args': {'spacy_model': 'en_core_web_sm'}}}
+
+
+@pytest.fixture
+def cgroup(tmpdir, monkeypatch):
+    def write(limit, usage, cache=0):
+        tmpdir.join('memory.max').write(limit)
+        tmpdir.join('memory.current').write(str(usage))
+        tmpdir.join('memory.stat').write('anon 0\ninactive_file {}\n'.format(cache))
+
+    files = [(str(tmpdir.join('memory.max')), str(tmpdir.join('memory.current')),
+              'inactive_file')]
+    monkeypatch.setattr(models, 'CGROUP_MEMORY_FILES', files)
+    return write
+
+
+def test_place_job_no_workers():
+    assert place_job([], None, 100 * MB) is None
+
+
+def test_place_job_fits():
+    workers = [WorkerLoad('a', 50 * MB, 0, set()), WorkerLoad('b', 500 * MB, 3, set())]
+    assert place_job(workers, None, 100 * MB).name == 'b'
+
+
+def test_place_job_packs_fullest_that_fits():
+    workers = [WorkerLoad('a', 4096 * MB, 0, set()), WorkerLoad('b', 300 * MB, 2, set()),
+               WorkerLoad('c', 1024 * MB, 1, set())]
+    assert place_job(workers, None, 200 * MB).name == 'b'
+
+
+def test_place_job_prefers_shared_model():
+    workers = [WorkerLoad('a', 300 * MB, 0, set()),
+               WorkerLoad('b', 2048 * MB, 5, {'en_core_web_lg'})]
+    assert place_job(workers, 'en_core_web_lg', 200 * MB).name == 'b'
+
+
+def test_place_job_shared_model_needs_no_memory():
+    workers = [WorkerLoad('a', 4096 * MB, 0, set()),
+               WorkerLoad('b', 10 * MB, 5, {'en_core_web_lg'})]
+    assert place_job(workers, 'en_core_web_lg', 900 * MB).name == 'b'
+    assert place_job(workers, None, 900 * MB).name == 'a'
+
+
+def test_place_job_tie_fewer_jobs():
+    workers = [WorkerLoad('a', 1024 * MB, 4, set()), WorkerLoad('b', 1024 * MB, 1, set())]
+    assert place_job(workers, None, 100 * MB).name == 'b'
+
+
+def test_place_job_max_jobs():
+    workers = [WorkerLoad('a', 300 * MB, 2, set()), WorkerLoad('b', 2048 * MB, 0, set())]
+    assert place_job(workers, None, 100 * MB).name == 'a'
+    assert place_job(workers, None, 100 * MB, max_jobs=2).name == 'b'
+
+
+def test_place_job_all_full():
+    workers = [WorkerLoad('a', 50 * MB, 0, set()), WorkerLoad('b', 80 * MB, 3, set())]
+    assert place_job(workers, None, 100 * MB).name == 'b'
+
+
+def test_get_worker_loads(projects):
+    workers = {'celery@a': {'free_memory': 1024 * MB,
+                            'jobs': ['prodigy.manual.ines', 'prodigy.teach.matt']},
+               'celery@b': {'jobs': ['prodigy.unknown.ines']}}
+    loads = dict((load.name, load) for load in get_worker_loads(workers, projects))
+    assert loads['celery@a'] == WorkerLoad('celery@a', 1024 * MB, 2, {'en_core_web_sm'})
+    assert loads['celery@b'] == WorkerLoad('celery@b', 0, 1, set())
+
+
+def test_get_cgroup_free_memory(cgroup):
+    cgroup('1073741824', 400 * MB, cache=100 * MB)
+    assert models.get_cgroup_free_memory() == 724 * MB
+    cgroup('max', 400 * MB)
+    assert models.get_cgroup_free_memory() is None
+
+
+def test_get_free_memory_budget(monkeypatch, cgroup):
+    cgroup('max', 0)
+    monkeypatch.setattr(models, 'get_tree_rss', lambda: 300 * MB)
+    assert models.get_free_memory(1024 * MB) == 724 * MB
+    assert models.get_free_memory(200 * MB) == 0
+
+
+def test_get_free_memory_cgroup(cgroup):
+    cgroup(str(512 * MB), 500 * MB)
+    assert models.get_free_memory() == 12 * MB
+
+
+def test_get_tree_rss():
+    assert models.get_tree_rss() >= models.get_rss() > 0
@@ -0,0 +1,51 @@
+# coding: utf8
+"""Benchmark storage size and load throughput of plain JSON example blobs
+against compressed blobs, including decoding only selected keys.
+
+Run from the src directory:
+
+    python -m benchmarks.bench_blobs [n_examples]
+"""
+from __future__ import unicode_literals, print_function
+
+import sys
+import time
+
+from app.database import dump_content, load_content
+from benchmarks.bench_database import make_examples
+
+
+def make_ner_examples(n):
+    examples = make_examples(n)
+    for eg in examples:
+        eg['spans'] = [{'start': 0, 'end': 7, 'token_start': 0, 'token_end': 0,
+                        'label': 'ORG'}]
+        eg['_session_id'] = 'manual_all.bcarvajal-default'
+        eg['_view_id'] = 'ner_manual'
+    return examples
+
+
+def run(label, blobs, keys=None):
+    start = time.time()
+    for blob in blobs:
+        load_content(blob, keys)
+    elapsed = time.time() - start
+    print('{:<24} {:>10.0f} examples/sec'.format(label, len(blobs) / elapsed))
+
+
+def main(n=50000):
+    examples = make_ner_examples(int(n))
+    plain = [dump_content(eg).encode('utf8') for eg in examples]
+    compressed = [dump_content(eg, compress=True) for eg in examples]
+    plain_size = sum(len(blob) for blob in plain)
+    compressed_size = sum(len(blob) for blob in compressed)
+    print('plain:      {:>12} bytes'.format(plain_size))
+    print('compressed: {:>12} bytes ({:.1%})'.format(compressed_size,
+                                                   compressed_size / plain_size))
+    run('load plain', plain)
+    run('load compressed', compressed)
+    run('load compressed (answer)', compressed, keys=['answer'])
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,83 @@
+# coding: utf8
+"""Load test of one worker running the real jobs of many users at once.
+Every user gets a ProdigyJob of the project, started through ProdigyFactory
+like the start_job task, and fetches and answers batches of questions in a
+loop. The users call their jobs one at a time, like a worker with
+--concurrency=1, and then each from its own greenlet, like a worker with
+-P gevent, so the speedup is what the gevent pool gains with the project's
+recipe, models and database.
+
+The greenlets share one process: they only overlap while the jobs wait,
+e.g. for the database, not while they run their model. With PostgreSQL,
+queries only overlap if psycopg2 is patched with psycogreen, see
+app.database.patch_psycopg.
+
+It uses the projects and database of the settings, and saves the answers
+to the datasets of the users bench0, bench1 and so on. Run from the src
+directory:
+
+    python -m benchmarks.bench_concurrency project_id [n_users] [n_batches]
+"""
+from __future__ import unicode_literals, print_function
+
+# patched before anything creates threads or sockets, like the worker does
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import time
+import gevent
+
+from app.settings import PROJECTS
+from app.tasks import ProdigyFactory
+from app.database import patch_psycopg
+
+
+def run(label, factory, job_ids, n_batches, concurrent):
+    calls = [0]
+
+    def user(job_id):
+        for _ in range(n_batches):
+            questions = factory.get_job(job_id).get_questions()['tasks']
+            calls[0] += 1
+            if not questions:
+                return
+            answers = [dict(task, answer='accept') for task in questions]
+            factory.get_job(job_id).give_answers({'answers': answers})
+            calls[0] += 1
+
+    start = time.time()
+    if concurrent:
+        gevent.joinall([gevent.spawn(user, job_id) for job_id in job_ids], raise_error=True)
+    else:
+        for job_id in job_ids:
+            user(job_id)
+    elapsed = time.time() - start
+    print('{:<12} {:>6} calls in {:>6.2f}s  {:>8.1f} calls/s'.format(label, calls[0], elapsed,
+                                                                     calls[0] / elapsed))
+    return calls[0] / elapsed
+
+
+def main(project_id, n_users=20, n_batches=5):
+    if project_id not in PROJECTS:
+        sys.exit('Unknown project "{}", pick one of: {}'.format(project_id, ', '.join(PROJECTS)))
+    n_users, n_batches = int(n_users), int(n_batches)
+    print('psycopg2 patched for gevent: {}'.format(patch_psycopg()))
+    factory = ProdigyFactory()
+    job_ids = []
+    for i in range(n_users):
+        user_id = 'bench{}'.format(i)
+        job_id = 'prodigy.{}.{}'.format(project_id, user_id)
+        factory.create_job(job_id, project_id, user_id)
+        job_ids.append(job_id)
+    try:
+        serial = run('serial', factory, job_ids, n_batches, False)
+        concurrent = run('gevent', factory, job_ids, n_batches, True)
+        print('speedup {:.1f}x'.format(concurrent / serial))
+    finally:
+        for job_id in job_ids:
+            factory._jobs[job_id].close()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,65 @@
+# coding: utf8
+"""Benchmark the database write path: one query per row (the previous
+behaviour) against the chunked bulk insert used by Database.add_examples.
+
+Run from the src directory:
+
+    python -m benchmarks.bench_database [n_examples]
+"""
+from __future__ import unicode_literals, print_function
+
+import sys
+import time
+import tempfile
+import ujson
+
+from prodigy.util import INPUT_HASH_ATTR, TASK_HASH_ATTR
+from app.database import connect, Example, Link
+
+
+def make_examples(n):
+    examples = []
+    for i in range(n):
+        text = 'Example number {} about Apple and David Bowie'.format(i)
+        tokens = [{'text': t, 'id': j} for j, t in enumerate(text.split())]
+        examples.append({INPUT_HASH_ATTR: i, TASK_HASH_ATTR: i * 7, 'text': text,
+                         'tokens': tokens, 'answer': 'accept'})
+    return examples
+
+
+def add_examples_per_row(db, examples, datasets):
+    with db.db.atomic():
+        ids = []
+        for eg in examples:
+            content = ujson.dumps(eg, escape_forward_slashes=False)
+            eg = Example.create(input_hash=eg[INPUT_HASH_ATTR],
+                                task_hash=eg[TASK_HASH_ATTR],
+                                content=content)
+            ids.append(eg.id)
+    for name in datasets:
+        with db.db.atomic():
+            dataset = db.add_dataset(name)
+            for eg in ids:
+                Link.create(dataset=dataset.id, example=eg)
+
+
+def run(label, func, n):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print('{:<12} {:>8} rows  {:>8.2f}s  {:>10.0f} rows/sec'.format(label, n, elapsed, n / elapsed))
+
+
+def main(n=20000):
+    n = int(n)
+    db = connect('sqlite', {'name': 'bench.db', 'path': tempfile.mkdtemp()})
+    examples = make_examples(n)
+    # each example is written once and linked to two datasets
+    run('per-row', lambda: add_examples_per_row(db, examples, ['bench_a', 'bench_b']), n * 3)
+    run('bulk', lambda: db.add_examples(examples, datasets=['bench_c', 'bench_d']), n * 3)
+    ids = [eg.id for eg in Example.select(Example.id)]
+    run('copy', lambda: db.link('bench_copy', ids), len(ids))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
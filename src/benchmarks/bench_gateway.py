@@ -0,0 +1,114 @@
+# coding: utf8
+"""Benchmark the job proxy routes with many annotators waiting on slow
+jobs: the Flask routes of main.py, served by a fixed pool of threads like
+a WSGI server, against the asyncio gateway of gateway.py. The jobs are
+stubs behind a local RPC server that take a while to answer, like a teach
+recipe scoring its stream.
+
+Run from the src directory (needs the app's dependencies):
+
+    python -m benchmarks.bench_gateway [n_clients] [n_calls] [latency_ms] [n_threads]
+"""
+from __future__ import unicode_literals, print_function
+
+import sys
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from aiohttp import ClientSession, web as aioweb
+
+from app.rpc import start_server
+from main import web, JOB_ADDRESSES
+from gateway import make_app
+
+
+class SlowJob(object):
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get_questions(self):
+        time.sleep(self.latency)
+        return {'tasks': [{'text': 'Stub task'}], 'total': 0, 'progress': None}
+
+
+class SlowFactory(object):
+    def __init__(self, latency):
+        self.job = SlowJob(latency)
+
+    def get_job(self, job_id):
+        return self.job
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class PoolServer(WSGIServer):
+    """A WSGI server that handles requests in a fixed pool of threads."""
+    def __init__(self, address, n_threads):
+        WSGIServer.__init__(self, address, QuietHandler)
+        self.pool = ThreadPoolExecutor(n_threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+async def load(label, url, job_ids, n_calls):
+    timings = []
+
+    async def annotator(client, job_id):
+        for _ in range(n_calls):
+            start = time.time()
+            async with client.get('{}/prodigy/{}/get_questions'.format(url, job_id)) as res:
+                assert res.status == 200
+                await res.read()
+            timings.append((time.time() - start) * 1000)
+
+    start = time.time()
+    async with ClientSession() as client:
+        await asyncio.gather(*[annotator(client, job_id) for job_id in job_ids])
+    elapsed = time.time() - start
+    timings.sort()
+    n = len(timings)
+    print('{:<8} {:>7.1f} calls/s  p50 {:>7.1f}ms  p99 {:>7.1f}ms'.format(
+        label, n / elapsed, timings[n // 2], timings[int(n * 0.99)]))
+
+
+async def run(n_clients, n_calls, n_threads):
+    flask_server = PoolServer(('127.0.0.1', 0), n_threads)
+    flask_server.set_app(web)
+    ThreadPoolExecutor(1).submit(flask_server.serve_forever)
+    flask_url = 'http://127.0.0.1:{}'.format(flask_server.server_port)
+
+    runner = aioweb.AppRunner(make_app(flask_url))
+    await runner.setup()
+    site = aioweb.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    gateway_url = 'http://127.0.0.1:{}'.format(site._server.sockets[0].getsockname()[1])
+
+    job_ids = ['prodigy.bench.user{}'.format(i) for i in range(n_clients)]
+    await load('flask', flask_url, job_ids, n_calls)
+    await load('gateway', gateway_url, job_ids, n_calls)
+    await runner.cleanup()
+    flask_server.shutdown()
+
+
+def main(n_clients=50, n_calls=10, latency_ms=200, n_threads=8):
+    address = start_server(SlowFactory(float(latency_ms) / 1000), '127.0.0.1', 0, '127.0.0.1')
+    for i in range(int(n_clients)):
+        JOB_ADDRESSES['prodigy.bench.user{}'.format(i)] = address
+    asyncio.get_event_loop().run_until_complete(run(int(n_clients), int(n_calls), int(n_threads)))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
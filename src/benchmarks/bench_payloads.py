@@ -0,0 +1,55 @@
+# coding: utf8
+"""Benchmark encoding a batch of NER questions with the tokens of every
+task, like the batches of ner.manual: json.dumps as the routes of main.py
+used it, against the encoder of app.payloads, with and without gzip.
+
+Run from the src directory:
+
+    python -m benchmarks.bench_payloads [n_tasks] [n_tokens] [n_runs]
+"""
+from __future__ import unicode_literals, print_function
+
+import sys
+import json
+import time
+import random
+
+from app.payloads import encode_payload, orjson
+
+WORDS = ['the', 'company', 'Apple', 'said', 'on', 'Tuesday', 'that', 'it', 'would', 'open',
+         'a', 'new', 'office', 'in', 'Berlin', 'último', 'año', '.', ',', 'revenue']
+
+
+def make_task(n_tokens):
+    words = [random.choice(WORDS) for _ in range(n_tokens)]
+    tokens = []
+    start = 0
+    for i, word in enumerate(words):
+        tokens.append({'text': word, 'start': start, 'end': start + len(word), 'id': i})
+        start += len(word) + 1
+    spans = [{'start': t['start'], 'end': t['end'], 'token_start': t['id'], 'token_end': t['id'],
+              'label': 'ORG'} for t in tokens[::25]]
+    return {'text': ' '.join(words), 'tokens': tokens, 'spans': spans,
+            '_input_hash': random.randint(-2**31, 2**31), '_task_hash': random.randint(-2**31, 2**31),
+            'meta': {'source': 'bench'}}
+
+
+def run(label, encode, batch, n_runs):
+    start = time.time()
+    for _ in range(n_runs):
+        body = encode(batch)
+    ms = (time.time() - start) * 1000 / n_runs
+    print('{:<14} {:>9} bytes  {:>7.2f}ms'.format(label, len(body), ms))
+
+
+def main(n_tasks=10, n_tokens=300, n_runs=50):
+    random.seed(0)
+    batch = {'tasks': [make_task(int(n_tokens)) for _ in range(int(n_tasks))], 'total': 0, 'progress': None}
+    n_runs = int(n_runs)
+    run('json', lambda b: json.dumps(b).encode('utf8'), batch, n_runs)
+    run('orjson' if orjson is not None else 'ujson', lambda b: encode_payload(b).body, batch, n_runs)
+    run('+ gzip', lambda b: encode_payload(b, gzip=True).body, batch, n_runs)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,65 @@
+# coding: utf8
+"""Benchmark the latency of job calls over the direct RPC channel against
+the Celery round-trip through the broker and result backend.
+
+Run from the src directory. Without arguments, a local RPC server with a
+stub job is measured. With the id of a running job, both paths are
+measured against the real worker (needs the broker and the worker):
+
+    python -m benchmarks.bench_rpc [job_id] [n_calls]
+"""
+from __future__ import unicode_literals, print_function
+
+import sys
+import time
+
+from app.rpc import RPCClient, start_server
+from benchmarks.bench_blobs import make_ner_examples
+
+
+class StubJob(object):
+    def __init__(self):
+        self.tasks = make_ner_examples(10)
+
+    def get_questions(self):
+        return {'tasks': self.tasks, 'total': 0, 'progress': None}
+
+
+class StubFactory(object):
+    job = StubJob()
+
+    def get_job(self, job_id):
+        return self.job
+
+
+def run(label, func, n):
+    timings = []
+    for _ in range(n):
+        start = time.time()
+        func()
+        timings.append((time.time() - start) * 1000)
+    timings.sort()
+    print('{:<8} mean {:>7.2f}ms  p50 {:>7.2f}ms  p99 {:>7.2f}ms'.format(
+        label, sum(timings) / n, timings[n // 2], timings[int(n * 0.99)]))
+
+
+def main(job_id=None, n=1000):
+    n = int(n)
+    client = RPCClient()
+    if job_id is None:
+        address = start_server(StubFactory(), '127.0.0.1', 0, '127.0.0.1')
+        run('rpc', lambda: client.call(address, 'stub', 'get_questions'), n)
+        return
+    from app.tasks import get_project, get_job_address
+
+    # get_project has no side effects on the job, unlike get_questions
+    address = get_job_address.apply_async(args=(job_id,), queue=job_id).get()
+    run('celery', lambda: get_project.apply_async(args=(job_id,), queue=job_id).get(), n)
+    run('rpc', lambda: client.call(address, job_id, 'get_project'), n)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1].isdigit():
+        main(None, sys.argv[1])
+    else:
+        main(*sys.argv[1:])
@@ -0,0 +1,87 @@
+# coding: utf8
+"""Simulate job placement over synthetic fleets of workers, comparing the
+load-aware placement of app.placement with the random choice it replaced.
+Jobs of random projects arrive one by one until a job is put on a worker
+it doesn't fit on, or fits on no worker at all. The load-aware placement
+must never do the former.
+
+Run from the src directory:
+
+    python -m benchmarks.sim_placement [n_fleets] [seed]
+"""
+from __future__ import unicode_literals, print_function
+
+import sys
+import random
+
+from app.placement import WorkerLoad, place_job
+
+MB = 1024 * 1024
+# (shared model or None for a private copy, footprint)
+PROJECTS = [('en_core_web_sm', 50 * MB), ('en_core_web_lg', 900 * MB),
+            (None, 400 * MB), (None, 900 * MB)]
+
+
+def make_fleet(rng):
+    return [WorkerLoad('celery@{}'.format(i), rng.choice([2, 4, 8, 16]) * 1024 * MB, 0, set())
+            for i in range(rng.randint(2, 12))]
+
+
+def assign(workers, worker, model, footprint):
+    holds = model is not None and model in worker.models
+    models = worker.models | {model} if model else worker.models
+    updated = worker._replace(free_memory=worker.free_memory - (0 if holds else footprint),
+                              jobs=worker.jobs + 1, models=models)
+    workers[workers.index(worker)] = updated
+    return holds
+
+
+def simulate(rng, choose, fleet):
+    """Place jobs until one lands on a worker it doesn't fit on, or until
+    it fits nowhere.
+    """
+    workers = list(fleet)
+    stats = {'jobs': 0, 'loads': 0, 'overloaded': 0}
+    capacity = sum(w.free_memory for w in workers)
+    while True:
+        model, footprint = rng.choice(PROJECTS)
+        fits = [w for w in workers if w.free_memory >= (0 if model in w.models else footprint)]
+        if not fits:
+            break
+        worker = choose(rng, workers, model, footprint)
+        if worker not in fits:
+            stats['overloaded'] = 1
+            break
+        holds = assign(workers, worker, model, footprint)
+        stats['jobs'] += 1
+        stats['loads'] += 0 if holds else 1
+    stats['used'] = 1 - sum(w.free_memory for w in workers) / float(capacity)
+    return stats
+
+
+def choose_random(rng, workers, model, footprint):
+    return rng.choice(workers)
+
+
+def choose_placement(rng, workers, model, footprint):
+    return place_job(workers, model, footprint)
+
+
+def main(n_fleets=200, seed=0):
+    rng = random.Random(int(seed))
+    fleets = [make_fleet(rng) for _ in range(int(n_fleets))]
+    for label, choose in [('random', choose_random), ('placement', choose_placement)]:
+        totals = {}
+        for i, fleet in enumerate(fleets):
+            stats = simulate(random.Random(i), choose, fleet)
+            for key, value in stats.items():
+                totals[key] = totals.get(key, 0) + value
+        print('{:<10} jobs placed {:>7}  model loads {:>7}  fleets overloaded {:>4}  '
+              'memory used {:>5.1%}'.format(label, totals['jobs'], totals['loads'],
+                                            totals['overloaded'], totals['used'] / len(fleets)))
+        if choose is choose_placement:
+            assert totals['overloaded'] == 0, 'job placed on a full worker while others had room'
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,134 @@
+# coding: utf8
+"""Serve the app with an asyncio gateway in front of it. The job proxy
+routes of the annotation loop are handled by the gateway, which waits for
+the workers without holding a thread per request, so many annotators can
+wait on slow recipes at once. All other requests are passed on to the
+Flask app of main.py, which runs in a thread of this process.
+
+    python3 gateway.py
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import threading
+import ujson
+from aiohttp import web as aioweb, ClientSession
+from multidict import CIMultiDict
+from werkzeug.http import parse_accept_header
+from werkzeug.serving import make_server
+
+from app.settings import *
+from app.aiorpc import AsyncRPCClient
+from app.rpc import RPCConnectionError
+from app.payloads import encode_payload
+from main import web, REGISTRY, JOB_ADDRESSES, JOB_TASKS, PAYLOADS, get_job_address
+
+
+RPC = AsyncRPCClient()
+HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'te', 'trailer',
+               'upgrade', 'proxy-authorization', 'proxy-authenticate', 'host')
+
+
+async def call_job(job_id, method, *args):
+    """Call a method of a running job, like main.call_job. Calls through
+    Celery, if RPC is disabled or the worker can't be reached, wait in a
+    thread.
+    """
+    loop = asyncio.get_event_loop()
+    if RPC_ENABLED:
+        address = JOB_ADDRESSES.get(job_id)
+        if address is None:
+            job = await loop.run_in_executor(None, REGISTRY.get_job, job_id)
+            address = job and job.get('address')
+        if address is None:
+            reply = get_job_address.apply_async(args=(job_id,), queue=job_id)
+            address = await loop.run_in_executor(None, reply.get) or ''
+        JOB_ADDRESSES[job_id] = address
+        if address:
+            try:
+                return await RPC.call(address, job_id, method, *args)
+            except RPCConnectionError as e:
+                web.logger.warning('[WARN] job %s unreachable over RPC: %s', job_id, e)
+                JOB_ADDRESSES.pop(job_id, None)
+    reply = JOB_TASKS[method].apply_async(args=(job_id,) + args, queue=job_id)
+    return await loop.run_in_executor(None, reply.get)
+
+
+def job_route(method, with_data=False):
+    async def handler(request):
+        args = []
+        if with_data:
+            try:
+                args.append(ujson.loads(await request.read()))
+            except ValueError:
+                raise aioweb.HTTPBadRequest(text='answers not valid')
+        result = await call_job(request.match_info['job_id'], method, *args)
+        accept = parse_accept_header(request.headers.get('Accept-Encoding'))
+        payload = encode_payload(result, accept['gzip'] > 0, JSON_GZIP_MIN_SIZE)
+        # the same statistics as the routes of the Flask app
+        PAYLOADS.record(method, payload)
+        response = aioweb.Response(body=payload.body, content_type='application/json')
+        if payload.encoding:
+            response.headers['Content-Encoding'] = payload.encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+    return handler
+
+
+async def proxy(request):
+    """Pass a request on to the Flask app and stream its response back."""
+    headers = CIMultiDict((k, v) for k, v in request.headers.items() if k.lower() not in HOP_HEADERS)
+    url = request.app['flask_url'] + request.path_qs
+    async with request.app['client'].request(request.method, url, headers=headers,
+                                             data=await request.read(),
+                                             allow_redirects=False) as upstream:
+        response = aioweb.StreamResponse(status=upstream.status, reason=upstream.reason)
+        for key, value in upstream.headers.items():
+            if key.lower() not in HOP_HEADERS:
+                response.headers.add(key, value)
+        await response.prepare(request)
+        async for chunk in upstream.content.iter_chunked(65536):
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+
+def start_flask(host, port):
+    """Run the Flask app in a background thread.
+    RETURNS (unicode): The URL of the Flask app.
+    """
+    server = make_server(host, port, web, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name='flask')
+    thread.daemon = True
+    thread.start()
+    return 'http://{}:{}'.format(host, server.server_port)
+
+
+def make_app(flask_url):
+    """
+    flask_url (unicode): The URL of the Flask app for all other requests.
+    RETURNS (aiohttp.web.Application): The gateway.
+    """
+    app = aioweb.Application()
+    app['flask_url'] = flask_url
+
+    async def start_client(app):
+        # responses are passed on as they are, e.g. gzipped exports
+        app['client'] = ClientSession(auto_decompress=False)
+
+    async def close_client(app):
+        await app['client'].close()
+
+    app.on_startup.append(start_client)
+    app.on_cleanup.append(close_client)
+    app.router.add_get('/prodigy/{job_id}/project', job_route('get_project'))
+    app.router.add_get('/prodigy/{job_id}/get_questions', job_route('get_questions'))
+    app.router.add_post('/prodigy/{job_id}/give_answers', job_route('give_answers', True))
+    app.router.add_post('/prodigy/{job_id}/answer_and_fetch', job_route('answer_and_fetch', True))
+    app.router.add_route('*', '/{path:.*}', proxy)
+    return app
+
+
+if __name__ == '__main__':
+    flask_url = start_flask('127.0.0.1', GATEWAY_FLASK_PORT)
+    aioweb.run_app(make_app(flask_url), host='0.0.0.0', port=8080)
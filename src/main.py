@@ -1,23 +1,46 @@
 # coding: utf8
 from __future__ import unicode_literals
 
-import random
+import zlib
+import time
 import logging
+import ujson
+from datetime import datetime
 from hashlib import md5
 from functools import wraps
-from pathlib import Path
 
-from flask import Flask, g, request, Response, json, render_template, send_from_directory, session, abort, flash, redirect, url_for
+from flask import Flask, g, request, Response, json, render_template, send_from_directory, send_file, session, abort, flash, redirect, url_for, stream_with_context
 from flask_cors import CORS, cross_origin
+from werkzeug.http import is_resource_modified
 from app.settings import *
-from app.database import connect, User
-from app.tasks import start_job, get_project, get_questions, give_answers, get_stats
+from app.database import connect, User, USER_CACHE
+from app.tasks import celery, REGISTRY, start_job, get_project, get_questions, give_answers, get_stats, get_job_address, \
+    answer_and_fetch
+from app.rpc import RPCClient, RPCConnectionError
+from app.placement import get_worker_loads, get_shared_model, place_job
+from app.catalog import ProjectCatalog
+from app.assets import StaticAssets
+from app.payloads import PayloadStats, encode_payload
+from prodigy.app import serve_static
 
 
 web = Flask(__name__)
 web.config.from_object(__name__)
 CORS(web, supports_credentials=True)
 DB = connect(PRODIGY_CONFIG['db'], PRODIGY_CONFIG['db_settings'][PRODIGY_CONFIG['db']])
+RPC = RPCClient()
+JOB_ADDRESSES = {}
+JOB_TASKS = {'get_project': get_project, 'get_questions': get_questions,
+             'give_answers': give_answers, 'answer_and_fetch': answer_and_fetch,
+             'get_stats': get_stats}
+CATALOG = ProjectCatalog(PROJECTS, DATA_DIR)
+# rendered task lists by user, with their ETag
+PAGES = {}
+# pages rendered by an earlier process may come from other templates
+STARTED = time.time()
+# the annotation app of prodigy, compressed once
+ASSETS = StaticAssets(serve_static()[0], ASSET_CACHE_DIR)
+PAYLOADS = PayloadStats()
 
 
 def auth_user(user):
@@ -28,8 +51,86 @@ def auth_user(user):
 
 
 def get_current_user():
-    if session.get('logged_in'):
-        return User.get(User.id == session['user_id'])
+    """Get the logged in user. The session keeps the user's id and name,
+    and the user is looked up in the cache of this process, so rendering a
+    page rarely queries the database.
+    RETURNS (User): The user, or None if no user is logged in.
+    """
+    if not session.get('logged_in'):
+        return None
+    user = USER_CACHE.get(session['user_id'])
+    if user is None:
+        # the user was deleted
+        session.pop('logged_in', None)
+        return None
+    if user.username != session.get('username'):
+        session['username'] = user.username
+    return user
+
+
+def conditional_response(etag, mtime, render, mimetype, private=False):
+    """Respond with 304 if the client's copy is current, so the content
+    is only rendered if it's sent.
+    etag (unicode): The ETag of the content.
+    mtime (float): When the content last changed.
+    render (callable): Called without arguments to get the content.
+    mimetype (unicode): The mimetype of the content.
+    private (bool): Whether the content is only for the current user.
+    RETURNS (Response): The response.
+    """
+    last_modified = datetime.utcfromtimestamp(max(mtime, STARTED))
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(render(), mimetype=mimetype)
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # clients cache the content, but check whether it changed every time
+    response.cache_control.no_cache = True
+    response.cache_control.private = private or None
+    return response
+
+
+def call_job(job_id, method, *args):
+    """Call a method of a running job. Calls go directly to the RPC server
+    of the worker that runs the job, and through Celery if RPC is disabled
+    or the worker can't be reached.
+    job_id (unicode): The job to call.
+    method (unicode): The job method, e.g. 'get_questions'.
+    RETURNS: The result of the job method.
+    """
+    if RPC_ENABLED:
+        address = JOB_ADDRESSES.get(job_id)
+        if address is None:
+            job = REGISTRY.get_job(job_id)
+            address = job and job.get('address')
+        if address is None:
+            reply = get_job_address.apply_async(args=(job_id,), queue=job_id)
+            address = reply.get() or ''
+        JOB_ADDRESSES[job_id] = address
+        if address:
+            try:
+                return RPC.call(address, job_id, method, *args)
+            except RPCConnectionError as e:
+                web.logger.warning('[WARN] job %s unreachable over RPC: %s', job_id, e)
+                JOB_ADDRESSES.pop(job_id, None)
+    reply = JOB_TASKS[method].apply_async(args=(job_id,) + args, queue=job_id)
+    return reply.get()
+
+
+def job_response(method, result):
+    """Send the result of a job method, gzipped if the client accepts it.
+    method (unicode): The job method, e.g. 'get_questions'.
+    result: The result of the job method.
+    RETURNS (Response): The response.
+    """
+    payload = encode_payload(result, request.accept_encodings['gzip'] > 0, JSON_GZIP_MIN_SIZE)
+    PAYLOADS.record(method, payload)
+    response = Response(payload.body, mimetype='application/json')
+    if payload.encoding:
+        response.content_encoding = payload.encoding
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 def login_required(f):
@@ -81,6 +182,8 @@ def login():
 @web.route('/logout/')
 def logout():
     session.pop('logged_in', None)
+    session.pop('user_id', None)
+    session.pop('username', None)
     flash('You were logged out')
     return redirect(url_for('task_list'))
 
@@ -94,26 +197,28 @@ def _inject_user():
 @login_required
 def task_list():
     user = get_current_user()
-    available_projects = []
-    for key, value in PROJECTS.items():
-        # skip if not visible, or if user is not in only_user list (if not defined all users are allowed)
-        if value['visible'] != True or ('only_user' in value and user.username not in value['only_user']):
-            continue
+    if user is None:
+        return redirect(url_for('login'))
+    username = user.username
+    projects, etag, mtime = CATALOG.get(username)
 
-        item = {'name': key, 'desc': value['desc'], 'stats': []}
+    def render():
+        context = {'base_url': BASE_URL, 'projects': [dict(item, stats=[]) for item in projects]}
+        return render_template('task_list.html', **context)
 
-        if 'instructions' in value:
-            help_path = Path('{}/{}'.format(DATA_DIR, value['instructions']))
-            if help_path.is_file():
-                with help_path.open('r', encoding='utf8') as f:
-                    item['instructions'] = f.read()
-            else:
-                item['instructions'] = value['instructions']
+    # flashed messages are only shown once, so those pages aren't cached
+    if session.get('_flashes'):
+        return render()
 
-        available_projects.append(item)
+    etag = md5('{}:{}:{}'.format(username, etag, STARTED).encode('utf8')).hexdigest()
 
-    context = {'base_url': BASE_URL, 'projects': available_projects}
-    return render_template('task_list.html', **context)
+    def render_cached():
+        cached = PAGES.get(username)
+        if cached is None or cached[0] != etag:
+            cached = PAGES[username] = (etag, render())
+        return cached[1]
+
+    return conditional_response(etag, mtime, render_cached, 'text/html', private=True)
 
 
 @web.route('/login')
@@ -135,7 +240,7 @@ def send_fonts(path):
 
 @web.route('/prodigy/<job>/index.html')
 def prodigy_index(job):
-    context = {'base_url': BASE_URL, 'job': job}
+    context = {'base_url': BASE_URL, 'job': job, 'asset_url': ASSETS.url}
     content = render_template('prodigy/index.html', **context)
     return Response(content, mimetype='text/html')
 
@@ -145,11 +250,9 @@ def prodigy_get_project(job_id):
     """Get the meta data and configuration of the current project.
     RETURNS (dict): The configuration parameters and settings.
     """
-    reply = get_project.apply_async(args=(job_id,),
-                                    queue=job_id)
-    result = reply.get()
+    result = call_job(job_id, 'get_project')
     # print('[CLIENT] call "get_project" for job {} responded with: {}'.format(job_id, repr(result)))
-    return Response(json.dumps(result), mimetype='application/json')
+    return job_response('get_project', result)
 
 
 @web.route('/prodigy/<job_id>/get_questions')
@@ -157,11 +260,9 @@ def prodigy_get_questions(job_id):
     """Get the next batch of tasks to annotate.
     RETURNS (dict): {'tasks': list, 'total': int, 'progress': float}
     """
-    reply = get_questions.apply_async(args=(job_id,),
-                                      queue=job_id)
-    result = reply.get()
+    result = call_job(job_id, 'get_questions')
     # print('[CLIENT] call "get_questions" for job {} responded with: {}'.format(job_id, repr(result)))
-    return Response(json.dumps(result), mimetype='application/json')
+    return job_response('get_questions', result)
 
 
 @web.route('/prodigy/<job_id>/give_answers', methods=['POST'])
@@ -174,55 +275,72 @@ def prodigy_give_answers(job_id):
         raise KeyError('answers not valid')
 
     data = request.get_json(force=True, cache=False)
-    reply = give_answers.apply_async(args=(job_id, data),
-                                      queue=job_id)
-    result = reply.get()
+    result = call_job(job_id, 'give_answers', data)
     # print('[CLIENT] call "get_questions" for job {} responded with: {}'.format(job_id, repr(result)))
-    return Response(json.dumps(result), mimetype='application/json')
+    return job_response('give_answers', result)
+
+
+@web.route('/prodigy/<job_id>/answer_and_fetch', methods=['POST'])
+def prodigy_answer_and_fetch(job_id):
+    """Receive annotated answers and get the next batch of tasks.
+    answers (list): A list of task dictionaries with an added `"answer"` key.
+    RETURNS (dict): {'tasks': list, 'total': int, 'progress': float}
+    """
+    if not request.is_json:
+        raise KeyError('answers not valid')
+
+    data = request.get_json(force=True, cache=False)
+    result = call_job(job_id, 'answer_and_fetch', data)
+    return job_response('answer_and_fetch', result)
 
 
 @web.route('/prodigy/<path:path>')
 def prodigy_static(path):
-    from prodigy.app import serve_static
-    base = serve_static()
-    return send_from_directory(base[0], path)
+    asset = ASSETS.get(path)
+    if asset is None:
+        abort(404)
+    encoding, filename = ASSETS.select(asset, request.accept_encodings)
+    # each encoding of a file is a different response
+    etag = '{}-{}'.format(asset.hash, encoding) if encoding else asset.hash
+    if is_resource_modified(request.environ, etag=etag):
+        response = send_file(filename, mimetype=asset.mimetype, add_etags=False)
+        if encoding:
+            response.content_encoding = encoding
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    if request.args.get('v') == asset.hash:
+        # the URL changes with the file, so it never has to be checked
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'
+    return response
 
 
 @web.route("/api/project")
 def project_list():
-    user = None
-    content = []
-    for key, value in PROJECTS.items():
-        # skip if not visible, or if user is not in only_user list (if not defined all users are allowed)
-        if value['visible'] != True or ('only_user' in value and user.username not in value['only_user']):
-            continue
-
-        item = {'name': key, 'desc': value['desc']}
-
-        if 'instructions' in value:
-            help_path = Path('{}/{}'.format(DATA_DIR, value['instructions']))
-            if help_path.is_file():
-                with help_path.open('r', encoding='utf8') as f:
-                    item['instructions'] = f.read()
-            else:
-                item['instructions'] = value['instructions']
-
-        content.append(item)
-
-    return Response(json.dumps(content), mimetype='application/json')
+    # the API has no user, so projects only for some users are left out
+    content, etag, mtime = CATALOG.get()
+    return conditional_response(etag, mtime, lambda: json.dumps(content), 'application/json')
 
 
 @web.route("/api/project/<project_id>/stats/<user_id>")
 def project_stat_for_user(project_id, user_id):
     job_id = 'prodigy.{}.{}'.format(project_id, user_id)
 
-    reply = get_stats.apply_async(args=(job_id,),
-                                  queue='prodigy',
-                                  routing_key=job_id)
-    result = reply.get()
+    result = call_job(job_id, 'get_stats')
     # print('[CLIENT] call "get_stats" for job {} responded with: {}'.format(job_id, repr(result)))
 
-    return Response(json.dumps(result), mimetype='application/json')
+    return job_response('get_stats', result)
+
+
+@web.route("/api/metrics/payloads")
+def payload_metrics():
+    """Get the size and encode time of the payloads of the job routes.
+    RETURNS (dict): The statistics of each route, keyed by job method.
+    """
+    return Response(json.dumps(PAYLOADS.get()), mimetype='application/json')
 
 
 @web.route("/api/project/<project>/comments/<username>", methods=['GET', 'POST'])
@@ -247,44 +365,88 @@ def project_create_job(project_id, user_id):
     #     else:
     #         break
 
-    workers = celery.control.inspect().stats()
-    web.logger.debug('[DEBUG] workers: %r', workers)
-
-    queues = celery.control.inspect().active_queues()
-    web.logger.debug('[DEBUG] active_queues: %r', queues)
-
-    active_queue = None
-    for worker in queues:
-        for queue in queues[worker]:
-            if queue['name'] == job_id:
-                active_queue = (worker, queue)
-                break
-
-    if active_queue is None:
-        worker, _ = random.choice(list(workers.items()))
-        web.logger.info('[INFO] bind queue %s to worker %s', job_id, worker)
-        reply = celery.control.add_consumer(
-            destination=(worker,),
-            queue=job_id,
-            exchange='prodigy',
-            exchange_type='direct',
-            options={
-                'queue_durable': True,
-                'exchange_durable': True,
-            },
-            reply=True)
-        web.logger.debug('[INFO] bind result: %r', reply)
-
-        reply = start_job.apply_async((job_id, project_id, user_id), queue=job_id)
-        hostname, job_id, job_uid = reply.get()
-        web.logger.info('[INFO] response from control - hostname: %s, job_id: %s, job_uid: %s', hostname, job_id, job_uid)
+    # the workers keep the job registry up to date with heartbeats
+    active_job = REGISTRY.get_job(job_id)
+
+    if active_job is None:
+        workers = REGISTRY.get_workers()
+        web.logger.debug('[DEBUG] workers: %r', workers)
+
+        settings = PROJECTS[project_id]
+        loads = get_worker_loads(workers, PROJECTS)
+        footprint = settings.get('model_footprint', MODEL_FOOTPRINT) * 1024 * 1024
+        worker = place_job(loads, get_shared_model(settings), footprint, WORKER_MAX_JOBS)
+        if worker is None:
+            abort(503)
+        worker = worker.name
+        if REGISTRY.claim_job(job_id, worker):
+            web.logger.info('[INFO] bind queue %s to worker %s', job_id, worker)
+            reply = celery.control.add_consumer(
+                destination=(worker,),
+                queue=job_id,
+                exchange='prodigy',
+                exchange_type='direct',
+                options={
+                    'queue_durable': True,
+                    'exchange_durable': True,
+                },
+                reply=True)
+            web.logger.debug('[INFO] bind result: %r', reply)
+
+            try:
+                reply = start_job.apply_async((job_id, project_id, user_id), queue=job_id)
+                hostname, job_id, job_uid, address = reply.get()
+            except Exception:
+                REGISTRY.release_job(job_id)
+                raise
+            JOB_ADDRESSES[job_id] = address or ''
+            web.logger.info('[INFO] response from control - hostname: %s, job_id: %s, job_uid: %s, address: %s', hostname, job_id, job_uid, address)
+        else:
+            web.logger.info('[INFO] job %s was placed by another request', job_id)
     else:
-        web.logger.info('[INFO] running in worker: %s', active_queue[0])
+        web.logger.info('[INFO] running in worker: %s', active_job['worker'])
 
     result = {'url': '/prodigy/{}/index.html'.format(job_id)}
     return Response(json.dumps(result), mimetype='application/json')
 
 
+@web.route("/api/dataset/<name>/export.jsonl.gz")
+@login_required
+def dataset_export(name):
+    """Stream a dataset as gzipped JSONL, reading and compressing it in
+    chunks so memory use doesn't depend on the size of the dataset.
+    answer (unicode): Optional answers to export, e.g. ?answer=accept&answer=reject.
+    since (int): Optional unix timestamp, only exports examples added to the
+        dataset since then.
+    """
+    if name not in DB:
+        abort(404)
+    answers = request.args.getlist('answer')
+    since = request.args.get('since', type=int)
+    if since is not None:
+        since = datetime.fromtimestamp(since)
+
+    def generate():
+        # wbits=31 writes a gzip header and trailer around the deflate stream
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        lines = []
+        for eg in DB.iter_dataset(name, chunk_size=EXPORT_CHUNK_SIZE, since=since,
+                                  answers=answers):
+            lines.append(ujson.dumps(eg, escape_forward_slashes=False))
+            if len(lines) >= EXPORT_CHUNK_SIZE:
+                data = compressor.compress('\n'.join(lines).encode('utf8') + b'\n')
+                lines = []
+                if data:
+                    yield data
+        if lines:
+            yield compressor.compress('\n'.join(lines).encode('utf8') + b'\n')
+        yield compressor.flush()
+
+    headers = {'Content-Disposition': 'attachment; filename={}.jsonl.gz'.format(name)}
+    return Response(stream_with_context(generate()), mimetype='application/gzip',
+                    headers=headers)
+
+
 @web.route("/api/user/login", methods=['POST'])
 def user_login():
     username = request.form['username']